@@ -0,0 +1,406 @@
+"""
+Benchmark of the template analysis and mask scripts
+
+Generates synthetic ENVI images, runs the scripts end to end with a stand-in feedback queue and reports the wall time
+of the single stages, the peak memory and the throughput as JSON. Results can be compared with a baseline (a JSON file
+written by an earlier run), regressions are listed and the exit code is 1 if any stage got slower than the tolerance.
+
+Example:
+    python benchmarks/benchmark_templates.py --sizes 640x480 1280x1024 --bands 40 --output results.json
+    python benchmarks/benchmark_templates.py --sizes 640x480 1280x1024 --bands 40 --baseline results.json
+
+This is not a test, the scripts are not checked for correct results.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import traceback
+import importlib.util
+import multiprocessing
+
+import numpy as np
+import cv2
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ANALYSIS_SCRIPT = os.path.join(REPOSITORY_PATH, "template_analysis_script", "template_analysis_script.py")
+MASK_SCRIPT = os.path.join(REPOSITORY_PATH, "template_mask_script", "template_mask_script.py")
+
+# stand-in for the feedback queue of RVS Analytics and the peak memory, shared with the scripts
+if REPOSITORY_PATH not in sys.path:
+    sys.path.append(REPOSITORY_PATH)
+from rvs_helpers import MessageList, peak_memory_mb  # noqa: E402
+
+ENVI_DATA_TYPES = {"uint8": 1, "int16": 2, "float32": 4, "uint16": 12}
+DATA_SCALE = {"uint8": 255, "int16": 4095, "uint16": 4095, "float32": 1}  # maximum value of the synthetic data
+MASK_WAVELENGTH = 800  # wavelength (nm) of the band used by the template masks (closest band)
+MASK_THRESHOLD = 0.35  # threshold of the template masks (reflectance, scaled for int16/uint16 data)
+
+
+def write_envi_image(img_file, samples, lines, bands, dtype="uint8", interleave="bsq", roi_layout="grid:3x4",
+                     seed=0):
+    """
+    Writes a synthetic ENVI image (binary file img_file + ".raw" and header img_file + ".hdr") showing a plant in
+    each ROI on soil background
+    :param img_file: path of the image without extension
+    :param samples: image width
+    :param lines: image height
+    :param bands: number of bands (400 - 1000 nm)
+    :param dtype: data type of the binary data (key in ENVI_DATA_TYPES)
+    :param interleave: "bsq", "bil" or "bip"
+    :param roi_layout: ROI layout the plants are placed in (see roi_items())
+    :param seed: seed of the random plant sizes and noise
+    """
+    rng = np.random.default_rng(seed)
+    wavelengths = synthetic_wavelengths(bands)
+
+    # reflectance spectra of soil and plants (green peak and red edge)
+    soil = 0.1 + 0.2 * (wavelengths - 400) / 600
+    plant = 0.05 + 0.1 * np.exp(-((wavelengths - 550) / 30) ** 2) + 0.55 / (1 + np.exp(-(wavelengths - 715) / 15))
+
+    plants = np.zeros((lines, samples), dtype=np.uint8)
+    for _, x, y, width, height in roi_items(roi_layout, samples, lines):
+        radius = max(int(min(width, height) / 2 * rng.uniform(0.3, 0.8)), 1)
+        cv2.circle(plants, (int(x + rng.uniform(-0.1, 0.1) * width), int(y + rng.uniform(-0.1, 0.1) * height)),
+                   radius, 1, -1)
+
+    reflectance = np.where(plants[:, :, np.newaxis] > 0, plant, soil).astype(np.float32)
+    reflectance += rng.normal(0, 0.02, reflectance.shape).astype(np.float32)
+    data = np.clip(reflectance, 0, 1) * DATA_SCALE[dtype]
+    data = data.astype(dtype) if dtype == "float32" else np.round(data).astype(dtype)
+
+    data = {"bsq": data.transpose(2, 0, 1), "bil": data.transpose(0, 2, 1), "bip": data}[interleave]
+    np.ascontiguousarray(data).tofile(img_file + ".raw")
+
+    with open(img_file + ".hdr", "w") as header:
+        header.write("ENVI\n")
+        header.write(f"samples = {samples}\nlines = {lines}\nbands = {bands}\nheader offset = 0\n")
+        header.write(f"data type = {ENVI_DATA_TYPES[dtype]}\ninterleave = {interleave}\nbyte order = 0\n")
+        header.write("wavelength units = nm\n")
+        header.write("wavelength = {\n" + ",\n".join(f"{wavelength:.2f}" for wavelength in wavelengths) + "}\n")
+
+
+def synthetic_wavelengths(bands):
+    """
+    :param bands: number of bands
+    :return: wavelengths of the synthetic images (whole numbers between 400 and 1000 nm)
+    """
+    return np.round(np.linspace(400, 1000, bands))
+
+
+def roi_items(roi_layout, samples, lines):
+    """
+    Creates the ROI items of a layout
+    :param roi_layout: "grid:RxC" (circles), "rect:RxC" (rectangles) in R rows and C columns or "none"
+    :param samples: image width
+    :param lines: image height
+    :return: ROI items as in the settings dictionary of RVS Analytics ([type, x, y, width, height])
+    """
+    if roi_layout == "none":
+        return []
+
+    shape, grid = roi_layout.split(":")
+    n_rows, n_cols = (int(n) for n in grid.split("x"))
+    roi_type = {"grid": "Circle", "rect": "Rectangle"}[shape]
+
+    cell_width = samples / n_cols
+    cell_height = lines / n_rows
+    size = int(0.8 * min(cell_width, cell_height))
+
+    return [[roi_type, int((col + 0.5) * cell_width), int((row + 0.5) * cell_height), size, size]
+            for row in range(n_rows) for col in range(n_cols)]
+
+
+def create_settings(img_file, out_folder, config, threshold=None):
+    """
+    Creates the settings dictionary passed to the scripts by RVS Analytics
+    :param img_file: path of the image without extension
+    :param out_folder: output folder
+    :param config: benchmark configuration
+    :param threshold: threshold of the mask (default: MASK_THRESHOLD scaled to the data type)
+    :return: settings dictionary
+    """
+    if threshold is None:
+        threshold = MASK_THRESHOLD * (1 if config["dtype"] in ("uint8", "float32") else DATA_SCALE[config["dtype"]])
+
+    wavelengths = synthetic_wavelengths(config["bands"])
+    mask_wavelength = int(wavelengths[np.argmin(np.abs(wavelengths - MASK_WAVELENGTH))])
+
+    return {"inputImage": img_file + ".hdr",
+            "outputFolder": out_folder,
+            "outputImage": os.path.join(out_folder, "mask_preview.png"),
+            "experimentSettings": {
+                "imageOptions": {"lensAngle": config["lens_angle"], "normalize": config["normalize"]},
+                "roiInfo": {"roiItems": roi_items(config["roi_layout"], config["samples"], config["lines"])},
+                "scriptOptions": {"general": {"custom_dropdown_script": "shape",
+                                              "dynamic_dropdown_script": config["index"],
+                                              "example_thresh_script": 0.5,
+                                              "example_checkbox_script": config["index"] != ""}},
+                "analysis": {"chartOptions": {"plot_selection": "plot_index"},
+                             "maskOptions": {"wavelength_mask": str(mask_wavelength),
+                                             "custom_dropdown_mask": "example_1",
+                                             "dynamic_dropdown_mask": config["index"],
+                                             "example_thresh_mask": threshold,
+                                             "example_checkbox_mask": True}}}}
+
+
+def load_script(script_file):
+    """
+    Imports a script by its path (the module name is the file name, so batch workers can import it as well)
+    :param script_file: path of the script
+    :return: module
+    """
+    script_name = os.path.splitext(os.path.basename(script_file))[0]
+    spec = importlib.util.spec_from_file_location(script_name, script_file)
+    script = importlib.util.module_from_spec(spec)
+    sys.modules[script_name] = script
+    spec.loader.exec_module(script)
+
+    return script
+
+
+def timed(timings, stage, function, *args, **kwargs):
+    """
+    Calls a function and records its wall time
+    :param timings: dictionary of stage: list of times
+    :param stage: name of the stage
+    :param function: function
+    :return: result of the function
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings.setdefault(stage, []).append(time.perf_counter() - start)
+
+    return result
+
+
+def run_config(config):
+    """
+    Runs the benchmark of one configuration, each image is processed once by every stage
+    :param config: benchmark configuration
+    :return: dictionary of the results
+    """
+    analysis = load_script(config["analysis_script"])
+    mask = load_script(config["mask_script"])
+    # the loading settings are defined in rvs_helpers.py (older scripts define them themselves)
+    for script in (analysis, mask, sys.modules.get("rvs_helpers")):
+        if hasattr(script, "LAZY_LOADING"):  # not applied to the worker processes of execute_batch()
+            script.LAZY_LOADING = config["lazy_loading"]
+    out_folder = os.path.join(config["work_dir"], "output")
+    os.makedirs(out_folder, exist_ok=True)
+
+    timings = {}
+    for img_file in config["images"]:
+        settings = create_settings(img_file, out_folder, config)
+        roi_list = settings["experimentSettings"]["roiInfo"]["roiItems"]
+
+        if hasattr(analysis, "prepare_spectral_data"):
+            spectral_array = timed(timings, "prepare_spectral_data", analysis.prepare_spectral_data, settings)
+            timed(timings, "read_bands", np.asarray, spectral_array.array_data)
+            timed(timings, "pseudo_rgb", getattr, spectral_array, "pseudo_rgb")
+            del spectral_array
+
+        # mask dialog: first preview of an image and update after moving the threshold slider
+        timed(timings, "mask_preview", mask.create_mask, settings, mask_preview=True)
+        timed(timings, "mask_preview_update", mask.create_mask,
+              create_settings(img_file, out_folder, config, threshold=settings["experimentSettings"]["analysis"]
+                              ["maskOptions"]["example_thresh_mask"] * 1.1), mask_preview=True)
+
+        spectral_array, binary_mask = timed(timings, "create_mask", analysis.create_mask, settings, mask_preview=False)
+        # process_rois() is defined in rvs_helpers.py (older scripts define it themselves)
+        process_rois = getattr(analysis, "process_rois", getattr(sys.modules.get("rvs_helpers"), "process_rois", None))
+        if process_rois is not None and roi_list:
+            timed(timings, "process_rois", process_rois, roi_list, spectral_array.pseudo_rgb)
+        if hasattr(analysis, "label_rois"):
+            timed(timings, "label_rois", analysis.label_rois, roi_list, binary_mask)
+        del spectral_array, binary_mask
+
+        feedback_queue = MessageList()
+        start = time.perf_counter()
+        analysis.execute(feedback_queue, config["analysis_name"], settings, "")
+        if hasattr(analysis, "get_image_writer"):  # images are written in the background
+            analysis.get_image_writer().flush()
+        timings.setdefault("execute", []).append(time.perf_counter() - start)
+
+    result = {"stages": {stage: {"median": statistics.median(times), "min": min(times), "n": len(times)}
+                         for stage, times in timings.items()}}
+    result["images_per_minute"] = 60 / result["stages"]["execute"]["median"]
+
+    if config["processes"] and hasattr(analysis, "execute_batch"):
+        feedback_queue = MessageList()
+        start = time.perf_counter()
+        analysis.execute_batch(feedback_queue, config["analysis_name"],
+                               create_settings(config["images"][0], out_folder, config), "", [
+                                   img_file + ".hdr" for img_file in config["images"]], processes=config["processes"])
+        result["batch_images_per_minute"] = 60 * len(config["images"]) / (time.perf_counter() - start)
+
+    result["peak_rss_mb"] = peak_memory_mb()
+
+    return result
+
+
+def _run_config_process(config, result_queue):
+    try:
+        result_queue.put(run_config(config))
+    except Exception:
+        result_queue.put({"error": traceback.format_exc()})
+
+
+def run_isolated(config):
+    """
+    Runs the benchmark of one configuration in a new process, so the peak memory belongs to this configuration only
+    and no caches are shared between configurations
+    :param config: benchmark configuration
+    :return: dictionary of the results
+    """
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    process = context.Process(target=_run_config_process, args=(config, result_queue))
+    process.start()
+
+    while True:
+        try:
+            result = result_queue.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                result = {"error": f"benchmark process failed (exit code {process.exitcode})"}
+                break
+
+    process.join()
+
+    return result
+
+
+def config_name(config):
+    return (f"{config['samples']}x{config['lines']}x{config['bands']} {config['dtype']} {config['interleave']} "
+            f"{config['roi_layout']} lens={config['lens_angle']} normalize={config['normalize']} "
+            f"lazy={config['lazy_loading']}")
+
+
+def compare(results, baseline, tolerance, min_delta=0.005):
+    """
+    Compares the results with a baseline
+    :param results: benchmark results
+    :param baseline: benchmark results of an earlier run
+    :param tolerance: relative slowdown (or memory increase) that is accepted
+    :param min_delta: slowdown in seconds that is always accepted (timing noise of short stages)
+    :return: list of regressions (descriptions)
+    """
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+
+    for result in results["results"]:
+        reference = baseline_results.get(result["name"])
+        if reference is None or "error" in result or "error" in reference:
+            continue
+
+        print(f"\n{result['name']}")
+        for stage, timing in result["stages"].items():
+            if stage not in reference["stages"]:
+                continue
+            reference_median = reference["stages"][stage]["median"]
+            ratio = timing["median"] / reference_median if reference_median > 0 else float("inf")
+            print(f"  {stage:24s} {reference_median * 1000:10.1f} ms -> "
+                  f"{timing['median'] * 1000:10.1f} ms ({ratio:5.2f}x)")
+            if ratio > 1 + tolerance and timing["median"] - reference_median > min_delta:
+                regressions.append(f"{result['name']}: {stage} {ratio:.2f}x slower "
+                                   f"(+{(timing['median'] - reference_median) * 1000:.1f} ms)")
+
+        if result.get("peak_rss_mb") and reference.get("peak_rss_mb"):
+            ratio = result["peak_rss_mb"] / reference["peak_rss_mb"]
+            print(f"  {'peak_rss':24s} {reference['peak_rss_mb']:10.1f} MB -> {result['peak_rss_mb']:10.1f} MB "
+                  f"({ratio:5.2f}x)")
+            if ratio > 1 + tolerance:
+                regressions.append(f"{result['name']}: peak memory {ratio:.2f}x higher")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the template analysis and mask scripts")
+    parser.add_argument("--sizes", nargs="+", default=["640x480", "1280x1024"], help="image sizes (samples x lines)")
+    parser.add_argument("--bands", nargs="+", type=int, default=[40], help="numbers of bands")
+    parser.add_argument("--dtypes", nargs="+", default=["uint8"], choices=sorted(ENVI_DATA_TYPES),
+                        help="data types of the images")
+    parser.add_argument("--interleave", nargs="+", default=["bsq"], choices=["bsq", "bil", "bip"])
+    parser.add_argument("--roi-layouts", nargs="+", default=["grid:3x4"],
+                        help="ROI layouts: grid:RxC (circles), rect:RxC (rectangles) or none")
+    parser.add_argument("--images", type=int, default=5, help="number of images per configuration")
+    parser.add_argument("--index", default="ndvi", help="index analyzed by the analysis script ('' = none)")
+    parser.add_argument("--lens-angle", type=int, default=0,
+                        help="lens angle (requires calibration_data/ in the working directory)")
+    parser.add_argument("--normalize", action="store_true", help="apply the dark normalization")
+    parser.add_argument("--no-lazy-loading", action="store_true", help="disable LAZY_LOADING of the scripts")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="also measure execute_batch() with this number of processes")
+    parser.add_argument("--analysis-script", default=ANALYSIS_SCRIPT)
+    parser.add_argument("--mask-script", default=MASK_SCRIPT)
+    parser.add_argument("--work-dir", help="folder of the synthetic images (default: temporary folder)")
+    parser.add_argument("--output", help="JSON file the results are written to (default: stdout)")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="accepted relative slowdown (default: 0.1)")
+    parser.add_argument("--min-delta", type=float, default=5,
+                        help="slowdown in ms that is always accepted, e.g. of sub-millisecond stages (default: 5)")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="rvs_benchmark_")
+    os.makedirs(work_dir, exist_ok=True)
+    results = {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__,
+               "platform": platform.platform(), "processor": platform.processor(), "results": []}
+
+    try:
+        for size in args.sizes:
+            samples, lines = (int(n) for n in size.lower().split("x"))
+            for bands in args.bands:
+                for dtype in args.dtypes:
+                    for interleave in args.interleave:
+                        for roi_layout in args.roi_layouts:
+                            config = {"samples": samples, "lines": lines, "bands": bands, "dtype": dtype,
+                                      "interleave": interleave, "roi_layout": roi_layout, "index": args.index,
+                                      "lens_angle": args.lens_angle, "normalize": args.normalize,
+                                      "lazy_loading": not args.no_lazy_loading, "processes": args.processes,
+                                      "analysis_script": os.path.abspath(args.analysis_script),
+                                      "analysis_name": os.path.splitext(os.path.basename(args.analysis_script))[0],
+                                      "mask_script": os.path.abspath(args.mask_script), "work_dir": work_dir}
+
+                            config["images"] = []
+                            for i in range(args.images):
+                                img_file = os.path.join(work_dir, f"{samples}x{lines}x{bands}_{dtype}_{interleave}_"
+                                                                  f"{roi_layout.replace(':', '')}_{i}")
+                                write_envi_image(img_file, samples, lines, bands, dtype, interleave, roi_layout, i)
+                                config["images"].append(img_file)
+
+                            name = config_name(config)
+                            print("Benchmarking", name, file=sys.stderr)
+                            result = run_isolated(config)
+                            if "error" in result:
+                                print(result["error"], file=sys.stderr)
+                            results["results"].append(dict(name=name, **result))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance, args.min_delta / 1000)
+        if regressions:
+            print("\nRegressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2087 @@
+"""
+Helpers shared by the template scripts (template_analysis_script and template_mask_script): loading and preparing
+ENVI images (lazy loading, on-disk cube cache, band-parallel preprocessing, undistortion), the cached stages of the mask
+preview and writing images, as well as the infrastructure of the analysis script: labeling the objects in the ROIs,
+shape and index statistics (in tiles of rows), the results table and store, writing the processed images in the
+background, the metrics of each image and the batch and streaming execution in worker processes. Copy this file next
+to your script (or into the folder above it).
+"""
+import os
+import sys
+import re
+import copy
+import collections
+import numpy as np
+import cv2
+import warnings
+import weakref
+import hashlib
+import threading
+import concurrent.futures
+import contextlib
+import time
+import json
+import glob
+import importlib.util
+import multiprocessing
+import cProfile
+import statistics
+from scipy import ndimage
+from plantcv import plantcv as pcv
+import rayn_utils
+import logging
+
+# performance settings (edit this, if required)
+LAZY_LOADING = True  # read bands from a memory map of the ENVI file when they are first accessed
+CUBE_CACHE_DIR = None  # folder of the on-disk cache of prepared cubes, e.g. "C:/rvs_cube_cache" (None = no cache)
+CUBE_CACHE_MAX_SIZE = 20 * 2 ** 30  # maximum size of the cube cache in bytes, least recently used cubes are deleted
+PREVIEW_MAX_SIZE = 1024  # longer side (px) of the mask preview image written for the mask dialog (None = full size)
+PREPROCESSING_THREADS = min(os.cpu_count() or 1, 8)  # threads converting and undistorting bands (1 = serial)
+
+# output images
+PNG_COMPRESSION = 1  # compression level of PNG images, 0-9 (higher = smaller files, but slower writing)
+JPEG_QUALITY = 95  # quality of JPEG images, 0-100
+WRITER_THREADS = 2  # threads writing the processed images in the background
+WRITER_QUEUE_SIZE = 4  # maximum number of processed images waiting to be written
+
+CACHE_BUDGET = 1024 * 2 ** 20  # maximum number of bytes of bands (and indices) cached per image
+TILE_MEMORY_BUDGET = None  # bytes used to compute an index in tiles of rows, e.g. 256 * 2 ** 20 (None = no tiles)
+RESULTS_CHUNK_ROWS = 100000  # maximum number of rows per chunk file of the results store
+
+# metrics
+SIGNAL_METRICS = True  # signal the time of each stage of execute() as 'metrics' message to the feedback queue
+PROFILE_DIR = None  # folder for cProfile dumps of images that take unusually long (None = no profiling)
+PROFILE_OUTLIER_FACTOR = 2.0  # images taking longer than this factor times the median of previous images are dumped
+
+# messages of the scripts are printed to stdout (shown by RVS Analytics) from this level on, e.g. logging.DEBUG for
+# details such as the ROI coordinates (None = no handler is added, the host application configures logging)
+LOG_LEVEL = logging.INFO
+
+INDEX_FUNCTIONS = rayn_utils.get_index_functions()  # available spectral indices, only loaded once
+
+_CUBE_CACHE_VERSION = 1  # version of the prepared cubes in CUBE_CACHE_DIR, cubes of other versions are not used
+_undistort_maps = {}  # camera calibration remap tables per (lens angle, width, height, calibration file hash)
+_cube_buffers = {}  # free buffers of whole cubes per (shape, data type)
+_preprocessing_executors = {}  # thread pool for the band-parallel preprocessing per process
+_metrics = threading.local()  # metrics of the image processed by the current thread
+_preview_cache = {}  # last inputs and result of each stage of the mask preview per (script, stage), of one image
+_preview_image_key = None  # image the cached stages of the mask preview belong to (see preview_key())
+_shared_stages = threading.local()  # stages of create_mask() shared while an image is analyzed
+_roi_mask_cache = {}  # filled ROIs per (ROI layout, image size)
+_mask_modules = {}  # external mask scripts per path: (modification time, module)
+_image_writers = {}  # background image writer per process
+_execute_times = collections.deque(maxlen=50)  # total time of the previous images (profiling of outliers)
+_results_stores = {}  # results store per (process, folder, fields)
+
+
+def get_logger(name):
+    """
+    Helper function that returns the logger of a script. Unless LOG_LEVEL is None, the messages are printed to stdout
+    (like print()) from LOG_LEVEL on and not passed on to the root logger.
+    :param name: name of the logger (__name__ of the script)
+    :return: logger
+    """
+    script_logger = logging.getLogger(name)
+    if LOG_LEVEL is not None and not script_logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        script_logger.addHandler(handler)
+        script_logger.setLevel(LOG_LEVEL)
+        script_logger.propagate = False
+
+    return script_logger
+
+
+logger = get_logger(__name__)
+
+
+def current_metrics():
+    """
+    :return: metrics of the image processed by the current thread (ImageMetrics) or None
+    """
+    return getattr(_metrics, "current", None)
+
+
+def set_current_metrics(metrics):
+    """
+    Helper function that sets the metrics the stages of the current thread are recorded to (see metrics_stage())
+    :param metrics: ImageMetrics or None
+    """
+    _metrics.current = metrics
+
+
+def metrics_stage(name):
+    """
+    Helper function that times a stage of the image processed by the current thread, e.g.
+    with metrics_stage("load"): ...
+    Nothing is recorded if no metrics are collected (e.g. in the mask preview).
+    :param name: name of the stage
+    :return: context manager
+    """
+    metrics = current_metrics()
+    return metrics.stage(name) if metrics is not None else contextlib.nullcontext()
+
+
+def count_bytes_read(n_bytes):
+    """
+    Helper function that adds to the bytes read from the image file by the current thread
+    :param n_bytes: number of bytes
+    """
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.add_bytes(n_bytes)
+
+
+def prepare_spectral_data(settings):
+    # file and folder
+    img_file = settings["inputImage"]
+    # undistort and normalize
+    image_options = settings["experimentSettings"]["imageOptions"]
+
+    lens_angle = image_options["lensAngle"]
+    dark_normalize = image_options["normalize"]
+
+    # check if a .hdr file name was provided and set img_file to the binary location
+    if os.path.splitext(img_file)[1] == ".hdr":
+        img_file = os.path.splitext(img_file)[0]
+
+    else:
+        warnings.warn("No header file provided. Processing not possible.")
+        return
+
+    # begin masking workflow
+    with metrics_stage("load"):
+        spectral_data = open_envi_image(img_file)
+
+    # undistort the image cube
+    if lens_angle != 0:  # only undistort if angle is selected
+        # bands and pseudo rgb image are undistorted when they are processed
+        with metrics_stage("undistort"):
+            spectral_data.undistort_maps = get_undistort_maps(lens_angle, spectral_data.samples, spectral_data.lines)
+        if spectral_data.undistort_maps is None:  # the remap tables don't match rayn_utils (see get_undistort_maps())
+            return undistort_with_rayn_utils(spectral_data, lens_angle, dark_normalize)
+
+    if CUBE_CACHE_DIR is not None:  # the prepared cube is memory mapped from the cache (or added to it)
+        spectral_data.array_data = cached_data_cube(spectral_data, lens_angle, dark_normalize)
+    elif not LAZY_LOADING or dark_normalize:  # the whole cube is processed at once
+        # rayn_utils.dark_normalize_array_data is applied to the whole cube, so normalized cubes are never loaded lazily
+        spectral_data.array_data = load_data_cube(spectral_data, dark_normalize)
+    # otherwise, bands are read, converted and undistorted when (and where) they are accessed
+
+    return spectral_data
+
+
+def load_data_cube(spectral_data, dark_normalize=False, chunk_size=4, out=None):
+    """
+    Helper function that reads the whole cube into a preallocated float32 buffer. The conversion to float32,
+    the scaling of uint8 data and the undistortion are done in one pass over chunks of bands, so no intermediate copies
+    of the whole cube are created. The chunks are processed in parallel (map_bands()). The dark normalization is
+    applied to the whole converted cube before it is undistorted (same order as rayn_utils), so it takes a second pass.
+    :param spectral_data: spectral data (LazySpectralData object, undistort_maps set if the bands are undistorted)
+    :param dark_normalize: apply the dark normalization
+    :param chunk_size: number of bands processed at once
+    :param out: array the cube is written to (lines x samples x bands, default: reused buffer)
+    :return: data cube (lines x samples x bands)
+    """
+    n_bands = len(spectral_data.wavelength_dict)
+    cube = out
+    if cube is None:
+        cube = acquire_cube_buffer(spectral_data, (spectral_data.lines, spectral_data.samples, n_bands), np.float32)
+    chunks = {}  # chunk buffer per thread, reused for all chunks processed by the thread
+
+    def process_chunk(bands):
+        thread = threading.get_ident()
+        if thread not in chunks:
+            chunks[thread] = np.empty((spectral_data.lines, spectral_data.samples, min(chunk_size, n_bands)),
+                                      dtype=np.float32)
+        layers = chunks[thread][:, :, :bands.stop - bands.start]
+        raw_bands = spectral_data.raw_bands(bands)
+        with metrics_stage("load"):  # reading, conversion and scaling are done at once
+            if spectral_data.d_type == np.uint8:  # convert 0-255 (orig.) to 0-1 range
+                np.divide(raw_bands, 255, out=layers, dtype=np.float32)
+            else:
+                np.copyto(layers, raw_bands, casting="unsafe")
+        count_bytes_read(raw_bands.nbytes)
+
+        if spectral_data.undistort_maps is not None and not dark_normalize:
+            with metrics_stage("undistort"):
+                layers = undistort_bands(layers, spectral_data.undistort_maps)
+
+        cube[:, :, bands] = layers
+
+    def undistort_chunk(bands):
+        with metrics_stage("undistort"):
+            cube[:, :, bands] = undistort_bands(cube[:, :, bands], spectral_data.undistort_maps)
+
+    band_chunks = [slice(start, min(start + chunk_size, n_bands)) for start in range(0, n_bands, chunk_size)]
+    map_bands(process_chunk, band_chunks, stage="load")
+
+    if dark_normalize:
+        with metrics_stage("normalize"):
+            cube_data = copy.copy(spectral_data)
+            cube_data.array_data = cube
+            np.copyto(cube, rayn_utils.dark_normalize_array_data(cube_data), casting="unsafe")
+        if spectral_data.undistort_maps is not None:
+            map_bands(undistort_chunk, band_chunks, stage="undistort")
+
+    return cube
+
+
+def cached_data_cube(spectral_data, lens_angle, dark_normalize):
+    """
+    Helper function that returns the prepared cube from the on-disk cache (CUBE_CACHE_DIR). The cubes are stored as
+    .npy files identified by the image file (path, size, modification time), the image options, the camera calibration
+    the cube was undistorted with (hash of the calibration file) and the version of the preparation. If the cube isn't
+    cached yet, it is prepared by load_data_cube() directly into a new cache file.
+    :param spectral_data: spectral data (LazySpectralData object, undistort_maps set if the bands are undistorted)
+    :param lens_angle: lens angle selected in the image options
+    :param dark_normalize: apply the dark normalization
+    :return: data cube (lines x samples x bands, read-only memory map)
+    """
+    binary_file = os.path.abspath(spectral_data.raw_data.filename)
+    file_stat = os.stat(binary_file)
+    key = (_CUBE_CACHE_VERSION, binary_file, file_stat.st_size, file_stat.st_mtime_ns, lens_angle,
+           calibration_hash(lens_angle) if lens_angle != 0 else None, bool(dark_normalize))
+    cache_file = os.path.join(CUBE_CACHE_DIR, hashlib.sha1(repr(key).encode()).hexdigest() + ".npy")
+
+    if os.path.exists(cache_file):
+        try:
+            cube = np.load(cache_file, mmap_mode="r")
+            os.utime(cache_file)  # marks the cube as recently used
+            return cube
+        except (OSError, ValueError):  # damaged file, the cube is prepared again
+            pass
+
+    # the cube is written to a temporary file first, so other processes never see an incomplete file
+    os.makedirs(CUBE_CACHE_DIR, exist_ok=True)
+    temp_file = f"{cache_file}.{os.getpid()}-{threading.get_ident()}.tmp"
+    shape = (spectral_data.lines, spectral_data.samples, len(spectral_data.wavelength_dict))
+    cube = np.lib.format.open_memmap(temp_file, mode="w+", dtype=np.float32, shape=shape)
+    try:
+        load_data_cube(spectral_data, dark_normalize, out=cube)
+        cube.flush()
+        del cube
+        os.replace(temp_file, cache_file)
+    except OSError:  # e.g. the cache file is in use by another process (Windows)
+        logger.warning("Prepared cube could not be added to the cache")
+        cube = None  # closes the memory map of the temporary file
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+        return load_data_cube(spectral_data, dark_normalize)
+
+    evict_cached_cubes(CUBE_CACHE_MAX_SIZE, keep=cache_file)
+
+    return np.load(cache_file, mmap_mode="r")
+
+
+def evict_cached_cubes(max_size, keep=None):
+    """
+    Helper function that deletes the least recently used cubes from the cache until its size is below max_size
+    :param max_size: maximum size of the cache in bytes
+    :param keep: cache file that is not deleted
+    """
+    cached_cubes = []
+    for file_name in os.listdir(CUBE_CACHE_DIR):
+        path = os.path.join(CUBE_CACHE_DIR, file_name)
+        try:
+            file_stat = os.stat(path)
+        except OSError:  # deleted in the meantime
+            continue
+        if file_name.endswith(".npy"):
+            cached_cubes.append((file_stat.st_mtime, file_stat.st_size, path))
+        elif file_name.endswith(".tmp") and file_stat.st_mtime < time.time() - 24 * 3600:  # left by a crashed process
+            cached_cubes.append((0, 0, path))
+
+    size = sum(file_size for _, file_size, _ in cached_cubes)
+    for _, file_size, path in sorted(cached_cubes):
+        if size <= max_size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            size -= file_size
+        except OSError:  # still in use (Windows)
+            pass
+
+
+def acquire_cube_buffer(owner, shape, dtype):
+    """
+    Helper function that returns a buffer for a whole cube. Buffers are reused: as soon as the owner is no longer used
+    (garbage collected), its buffer is available for the next image of the same size.
+    :param owner: object the buffer belongs to (e.g. the spectral data object)
+    :param shape: shape of the buffer
+    :param dtype: data type of the buffer
+    :return: uninitialized buffer
+    """
+    key = (tuple(shape), np.dtype(dtype).str)
+    free_buffers = _cube_buffers.get(key)
+    buffer = free_buffers.pop() if free_buffers else np.empty(shape, dtype=dtype)
+
+    weakref.finalize(owner, _release_cube_buffer, key, buffer).atexit = False
+
+    return buffer
+
+
+def _release_cube_buffer(key, buffer):
+    if key not in _cube_buffers:  # only keep the buffers of the last image size
+        _cube_buffers.clear()
+    _cube_buffers.setdefault(key, []).append(buffer)
+
+
+def map_bands(function, items, stage=None):
+    """
+    Helper function that applies a function to independent chunks of bands in parallel (PREPROCESSING_THREADS).
+    The conversion and undistortion are done by NumPy and OpenCV, which release the GIL, so threads
+    share the work of an image. Every chunk is processed the same way as in serial mode, so the results are identical.
+    The stages timed in the threads are counted for the stage of the calling thread.
+    :param function: function processing one item
+    :param items: chunks of bands (e.g. slices or band indices)
+    :param stage: name of the stage the parallel processing is timed as (default: stage of the calling thread)
+    :return: list of the results (in the order of the items)
+    """
+    items = list(items)
+    if PREPROCESSING_THREADS <= 1 or len(items) <= 1 or threading.current_thread().name.startswith("preprocessing"):
+        return [function(item) for item in items]
+
+    metrics = current_metrics()
+
+    def run(item):
+        set_current_metrics(metrics)  # bytes read by the threads are counted for the image
+        try:
+            return function(item)
+        finally:
+            set_current_metrics(None)
+
+    with metrics_stage(stage) if stage is not None else contextlib.nullcontext():
+        return list(get_preprocessing_executor().map(run, items))
+
+
+def get_preprocessing_executor():
+    """
+    Helper function that returns the thread pool of the band-parallel preprocessing of this process
+    :return: ThreadPoolExecutor
+    """
+    pid = os.getpid()
+    if pid not in _preprocessing_executors:
+        _preprocessing_executors.clear()  # threads are not inherited by forked worker processes
+        _preprocessing_executors[pid] = concurrent.futures.ThreadPoolExecutor(PREPROCESSING_THREADS,
+                                                                              thread_name_prefix="preprocessing")
+
+    return _preprocessing_executors[pid]
+
+
+def get_undistort_maps(lens_angle, width, height):
+    """
+    Helper function that loads the camera calibration of a lens angle and computes the remap tables for the
+    undistortion. Both are cached per (lens angle, width, height), so the calibration file is only loaded again if its
+    contents changed (calibration_hash()).
+    The first time, the tables are checked against rayn_utils.undistort_data_cube (undistort_maps_match()). If the
+    results differ, a warning is shown and None is returned, i.e. the images are undistorted by rayn_utils.
+    :param lens_angle: lens angle selected in the image options
+    :param width: image width (samples)
+    :param height: image height (lines)
+    :return: remap tables (map_1, map_2) for cv2.remap or None
+    """
+    key = (lens_angle, width, height, calibration_hash(lens_angle))
+    if key not in _undistort_maps:
+        mtx, dist = rayn_utils.load_coefficients(calibration_file(lens_angle))  # depending on the lens angle
+        undistort_maps = compute_undistort_maps(mtx, dist, width, height)
+        if not undistort_maps_match(undistort_maps, mtx, dist):
+            warnings.warn(f"The undistortion of lens angle {lens_angle} differs from rayn_utils.undistort_data_cube. "
+                          "Images are undistorted as a whole by rayn_utils (slower).")
+            undistort_maps = None
+        _undistort_maps[key] = undistort_maps
+
+    return _undistort_maps[key]
+
+
+def calibration_file(lens_angle):
+    """
+    :param lens_angle: lens angle selected in the image options
+    :return: path of the camera calibration file of the lens angle
+    """
+    return f"calibration_data/{lens_angle}_calibration_data.yml"  # select the data set
+
+
+def calibration_hash(lens_angle):
+    """
+    Helper function that identifies the camera calibration of a lens angle by the contents of its calibration file, so
+    cached remap tables and undistorted cubes are not used after the calibration was recomputed
+    :param lens_angle: lens angle selected in the image options
+    :return: SHA-1 hash of the calibration file, None if it doesn't exist
+    """
+    try:
+        with open(calibration_file(lens_angle), "rb") as file:
+            return hashlib.sha1(file.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def compute_undistort_maps(mtx, dist, width, height):
+    """
+    Helper function that computes the remap tables of a camera calibration, the same tables cv2.undistort computes
+    internally on every call
+    :param mtx: camera matrix
+    :param dist: distortion coefficients
+    :param width: image width (samples)
+    :param height: image height (lines)
+    :return: remap tables (map_1, map_2) for cv2.remap
+    """
+    return cv2.initUndistortRectifyMap(mtx, dist, None, mtx, (width, height), cv2.CV_16SC2)
+
+
+def undistort_maps_match(undistort_maps, mtx, dist, n_bands=5):
+    """
+    Helper function that checks if undistort_bands() gives the same result as rayn_utils.undistort_data_cube (same
+    interpolation, border mode and image size) for a random cube of the image size
+    :param undistort_maps: remap tables from compute_undistort_maps()
+    :param mtx: camera matrix
+    :param dist: distortion coefficients
+    :param n_bands: number of bands of the test cube (more than 4, cv2.remap processes up to 4 bands per call)
+    :return: True if the results are equal
+    """
+    height, width = undistort_maps[0].shape[:2]
+    test_cube = np.random.default_rng(0).random((height, width, n_bands), dtype=np.float32)
+    expected = np.asarray(rayn_utils.undistort_data_cube(test_cube.copy(), mtx, dist))
+
+    return expected.shape == test_cube.shape and np.allclose(undistort_bands(test_cube, undistort_maps), expected,
+                                                             rtol=0, atol=1e-6)
+
+
+def undistort_with_rayn_utils(spectral_data, lens_angle, dark_normalize):
+    """
+    Helper function that loads the whole cube and undistorts it and the pseudo rgb image with
+    rayn_utils.undistort_data_cube, used if the remap tables don't match rayn_utils (see get_undistort_maps())
+    :param spectral_data: spectral data (LazySpectralData object)
+    :param lens_angle: lens angle selected in the image options
+    :param dark_normalize: apply the dark normalization
+    :return: spectral data
+    """
+    mtx, dist = rayn_utils.load_coefficients(calibration_file(lens_angle))
+    cube = load_data_cube(spectral_data, dark_normalize)
+    with metrics_stage("undistort"):
+        spectral_data.array_data = rayn_utils.undistort_data_cube(cube, mtx, dist)
+        spectral_data.pseudo_rgb = rayn_utils.undistort_data_cube(spectral_data.pseudo_rgb, mtx, dist)
+
+    return spectral_data
+
+
+def undistort_bands(bands, undistort_maps, rows=slice(None), cols=slice(None), row_offset=0):
+    """
+    Helper function that undistorts a single band or a stack of bands with precomputed remap tables
+    :param bands: 2d band or 3d array (lines x samples x bands)
+    :param undistort_maps: remap tables from get_undistort_maps()
+    :param rows: rows of the undistorted image that are computed (default: all)
+    :param cols: columns of the undistorted image that are computed (default: all)
+    :param row_offset: first row of the distorted image in bands, if bands only contains the rows required for the
+                       region (see undistort_source_rows())
+    :return: undistorted band(s), only the selected region
+    """
+    map_1 = np.ascontiguousarray(undistort_maps[0][rows, cols])
+    map_2 = np.ascontiguousarray(undistort_maps[1][rows, cols])
+    if row_offset:
+        map_1 = map_1 - np.array([0, row_offset], dtype=map_1.dtype)
+
+    if bands.ndim == 2:
+        return cv2.remap(bands, map_1, map_2, cv2.INTER_LINEAR)
+
+    # cv2.remap handles up to 4 channels per call
+    undistorted = np.empty(map_1.shape[:2] + bands.shape[2:], dtype=bands.dtype)
+    for start in range(0, bands.shape[2], 4):
+        batch = np.ascontiguousarray(bands[:, :, start:start + 4])
+        undistorted[:, :, start:start + 4] = cv2.remap(batch, map_1, map_2, cv2.INTER_LINEAR).reshape(
+            map_1.shape[:2] + (batch.shape[2],))
+
+    return undistorted
+
+
+def undistort_source_rows(undistort_maps, rows=slice(None), cols=slice(None)):
+    """
+    Helper function that finds the rows of the distorted image a region of the undistorted image is interpolated from
+    :param undistort_maps: remap tables from get_undistort_maps()
+    :param rows: rows of the undistorted region
+    :param cols: columns of the undistorted region
+    :return: rows of the distorted image (slice), including the halo required for the interpolation
+    """
+    height = undistort_maps[0].shape[0]
+    map_y = undistort_maps[0][rows, cols, 1]  # integer part of the source coordinates
+    start = min(max(int(map_y.min()), 0), height - 1)
+    stop = min(max(int(map_y.max()) + 2, start + 1), height)  # the bilinear interpolation also uses the next row
+
+    return slice(start, stop)
+
+
+# ENVI "data type" header codes
+ENVI_DATA_TYPES = {1: np.uint8, 2: np.int16, 3: np.int32, 4: np.float32, 5: np.float64,
+                   12: np.uint16, 13: np.uint32, 14: np.int64, 15: np.uint64}
+
+
+def read_envi_header(header_file):
+    """
+    Helper function that parses the header (.hdr) of an ENVI file
+    :param header_file: path to the .hdr file
+    :return: dictionary of header entries (lower case keys, values in curly brackets are returned as lists)
+    """
+    with open(header_file, "r") as f:
+        header_text = f.read()
+
+    header = {}
+    for match in re.finditer(r"^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)", header_text, re.MULTILINE):
+        key = match.group(1).strip().lower()
+        value = match.group(2).strip()
+        if value.startswith("{"):  # list of values, possibly spread over multiple lines
+            value = [item.strip() for item in value[1:-1].split(",") if item.strip()]
+        header[key] = value
+
+    return header
+
+
+def open_envi_image(img_file):
+    """
+    Helper function that memory maps the binary data of an ENVI file without reading it
+    :param img_file: path to the ENVI file without extension (the header is expected at img_file + ".hdr")
+    :return: spectral data (LazySpectralData object), bands are only read when they are accessed
+    """
+    header = read_envi_header(img_file + ".hdr")
+
+    binary_file = find_envi_binary(img_file)
+    if binary_file is None:
+        raise FileNotFoundError(f"No binary data found for ENVI header {img_file}.hdr")
+
+    samples = int(header["samples"])
+    lines = int(header["lines"])
+    bands = int(header["bands"])
+
+    d_type = np.dtype(ENVI_DATA_TYPES[int(header.get("data type", 1))])
+    d_type = d_type.newbyteorder(">" if header.get("byte order", "0") == "1" else "<")
+
+    interleave = header.get("interleave", "bsq").lower()
+    shape = {"bsq": (bands, lines, samples),
+             "bil": (lines, bands, samples),
+             "bip": (lines, samples, bands)}[interleave]
+
+    raw_data = np.memmap(binary_file, dtype=d_type, mode="r", offset=int(header.get("header offset", 0)),
+                         shape=shape)
+
+    return LazySpectralData(img_file, header, raw_data)
+
+
+def find_envi_binary(img_file):
+    """
+    Helper function that finds the binary data of an ENVI file, which is either stored without extension (PlantCV
+    default) or with one of the common extensions
+    :param img_file: path to the ENVI file without extension
+    :return: path to the binary data, None if it doesn't exist
+    """
+    for extension in ("", ".raw", ".img", ".dat", ".bin"):
+        if os.path.isfile(img_file + extension):
+            return img_file + extension
+
+    return None
+
+
+class LazySpectralData:
+    """
+    Drop-in replacement for the PlantCV spectral data object returned by pcv.readimage(mode='envi').
+    The image data stays in a memory map; array_data and pseudo_rgb are only computed when they are accessed.
+    """
+    def __init__(self, filename, header, raw_data):
+        interleave = header.get("interleave", "bsq").lower()
+        n_bands = raw_data.shape[{"bsq": 0, "bil": 1, "bip": 2}[interleave]]
+        wavelengths = [float(wavelength) for wavelength in header.get("wavelength", [])] or list(range(n_bands))
+
+        self.raw_data = raw_data
+        self.filename = filename
+        self.interleave = interleave
+        self.samples = int(header["samples"])
+        self.lines = int(header["lines"])
+        self.d_type = raw_data.dtype.type
+        self.wavelength_dict = {wavelength: float(i) for i, wavelength in enumerate(wavelengths)}
+        self.max_wavelength = wavelengths[-1]
+        self.min_wavelength = wavelengths[0]
+        self.wavelength_units = header.get("wavelength units", "nm")
+        self.array_type = "datacube"
+        self.default_bands = header.get("default bands")
+        self.metadata = {}
+        self.undistort_maps = None  # remap tables, set if the bands have to be undistorted
+        self.array_data = LazyDataCube(self)
+        self._pseudo_rgb = None
+
+    @property
+    def max_value(self):
+        return float(np.amax(self.raw_data))
+
+    @property
+    def min_value(self):
+        return float(np.amin(self.raw_data))
+
+    @property
+    def pseudo_rgb(self):
+        if self._pseudo_rgb is None:
+            with metrics_stage("pseudo_rgb"):
+                self._pseudo_rgb = self.make_pseudo_rgb()
+            if self.undistort_maps is not None:
+                with metrics_stage("undistort"):
+                    self._pseudo_rgb = undistort_bands(self._pseudo_rgb, self.undistort_maps)
+        return self._pseudo_rgb
+
+    @pseudo_rgb.setter
+    def pseudo_rgb(self, value):
+        self._pseudo_rgb = value
+
+    def raw_band(self, band):
+        """
+        :param band: band index
+        :return: 2d view on the memory mapped raw data of the band (nothing is read yet)
+        """
+        if self.interleave == "bsq":
+            return self.raw_data[band]
+        elif self.interleave == "bil":
+            return self.raw_data[:, band, :]
+        return self.raw_data[:, :, band]
+
+    def raw_bands(self, bands):
+        """
+        :param bands: band indices (slice)
+        :return: 3d view (lines x samples x bands) on the memory mapped raw data of the bands (nothing is read yet)
+        """
+        if self.interleave == "bsq":
+            return self.raw_data[bands].transpose(1, 2, 0)
+        elif self.interleave == "bil":
+            return self.raw_data[:, bands, :].transpose(0, 2, 1)
+        return self.raw_data[:, :, bands]
+
+    def make_pseudo_rgb(self):
+        """
+        Builds the pseudo rgb image (BGR, uint8) from three raw bands the same way pcv.readimage does
+        :return: pseudo rgb image
+        """
+        wavelengths = np.array(list(self.wavelength_dict))
+        if self.default_bands is not None:
+            band_ids = [int(band) for band in self.default_bands[:3]]
+        elif np.amax(wavelengths) >= 600 and np.amin(wavelengths) <= 490:
+            band_ids = [int(np.argmin(np.abs(wavelengths - wavelength))) for wavelength in (480, 540, 630)]
+        else:  # first, middle and last band
+            band_ids = [0, int((len(wavelengths) - 1) / 2), len(wavelengths) - 1]
+
+        channels = []
+        for band in band_ids:
+            count_bytes_read(self.raw_band(band).nbytes)
+            channel = self.raw_band(band).astype(np.float64) ** (1 / 2.2)  # gamma correction
+            # scale each channel up to 255
+            channel = np.interp(channel, (np.nanmin(channel), np.nanmax(channel)), (0, 255))
+            channels.append(channel.astype(np.uint8))
+
+        return np.stack(channels, axis=-1)
+
+
+class ArrayCache:
+    """
+    LRU cache for numpy arrays (or objects holding one in array_data) limited by the total number of bytes.
+    The least recently used entries are evicted when the budget is exceeded.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = collections.OrderedDict()  # key: (value, number of bytes)
+        self._lock = threading.RLock()  # bands are cached by the threads of the band-parallel preprocessing
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        n_bytes = getattr(value, "nbytes", None)
+        if n_bytes is None:
+            n_bytes = getattr(getattr(value, "array_data", None), "nbytes", 0)
+
+        with self._lock:
+            self.pop(key)
+            self._entries[key] = (value, n_bytes)
+            self.n_bytes += n_bytes
+
+            while self.n_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.n_bytes -= evicted_bytes
+
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, n_bytes = self._entries.pop(key)
+            self.n_bytes -= n_bytes
+            return value
+
+
+class LazyDataCube(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    Cube-like object (lines x samples x bands) used as array_data of LazySpectralData. A band is read from the
+    memory map, converted to float32 and undistorted the first time it is indexed, e.g.
+    array_data[:, :, i]. If only a region of a band is indexed (e.g. a tile of rows), only the rows required for that
+    region are read and undistorted and nothing is cached. Converting the whole object with np.asarray() reads all
+    bands, so do other operations: advanced indexing (e.g. array_data[mask > 0]), arithmetic, numpy functions and
+    ndarray methods (e.g. array_data.max()) are applied to the whole cube.
+    """
+    def __init__(self, spectral_data):
+        self.spectral_data = spectral_data
+        self.shape = (spectral_data.lines, spectral_data.samples, len(spectral_data.wavelength_dict))
+        self.dtype = np.dtype("float32")
+        self.ndim = 3
+        # processed bands ("band", i)
+        self._cache = ArrayCache(CACHE_BUDGET)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __array__(self, dtype=None, copy=None):
+        cube = self[:, :, :]
+        return cube if dtype is None else cube.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(np.asarray(item) if isinstance(item, LazyDataCube) else item for item in inputs)
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getattr__(self, name):  # other ndarray attributes and methods, e.g. max() or reshape()
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(np.asarray(self), name)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if not all(item is Ellipsis or isinstance(item, slice) or
+                   isinstance(item, (int, np.integer)) and not isinstance(item, bool) for item in key):
+            return np.asarray(self)[key]  # advanced indexing (index or boolean arrays, np.newaxis)
+        if any(item is Ellipsis for item in key):
+            position = next(i for i, item in enumerate(key) if item is Ellipsis)
+            key = key[:position] + (slice(None),) * (4 - len(key)) + key[position + 1:]
+        rows, cols, bands = key + (slice(None),) * (3 - len(key))
+
+        if isinstance(bands, (int, np.integer)):
+            return self.band(int(bands), rows, cols)
+
+        band_ids = np.arange(self.shape[2])[bands]
+        return np.stack(map_bands(lambda band: self.band(int(band), rows, cols), np.atleast_1d(band_ids)), axis=-1)
+
+    def astype(self, dtype):
+        return np.asarray(self).astype(dtype)
+
+    def band(self, band, rows=slice(None), cols=slice(None)):
+        """
+        :param band: band index
+        :param rows: selected rows (default: all)
+        :param cols: selected columns (default: all)
+        :return: converted (float32, 0-1 range for uint8 data) and undistorted 2d band (selected region)
+        """
+        band = band % self.shape[2]
+        if ("band", band) in self._cache:
+            return self._cache.get(("band", band))[rows, cols]
+
+        undistort_maps = self.spectral_data.undistort_maps
+        is_region = isinstance(rows, slice) and isinstance(cols, slice) and (rows, cols) != (slice(None), slice(None))
+        if is_region:  # only read the rows of the requested region
+            if undistort_maps is None:
+                return self.process_band(band, rows)[:, cols]
+            source_rows = undistort_source_rows(undistort_maps, rows, cols)
+            source = self.process_band(band, source_rows)
+            with metrics_stage("undistort"):
+                return undistort_bands(source, undistort_maps, rows, cols, source_rows.start)
+
+        layer = self.process_band(band)
+        if undistort_maps is not None:
+            with metrics_stage("undistort"):
+                layer = undistort_bands(layer, undistort_maps)
+        self._cache.put(("band", band), layer)
+
+        return layer[rows, cols]
+
+    def process_band(self, band, rows=slice(None)):
+        spectral_data = self.spectral_data
+        raw_band = spectral_data.raw_band(band)[rows]
+        with metrics_stage("load"):  # reading from the memory map and conversion to float32
+            layer = raw_band.astype("float32")
+        count_bytes_read(raw_band.nbytes)
+
+        if spectral_data.d_type == np.uint8:  # only convert if data seems to be uint8
+            with metrics_stage("convert"):
+                layer /= 255  # convert 0-255 (orig.) to 0-1 range
+
+        return layer
+
+
+def preview_key(settings):
+    """
+    Helper function that identifies the prepared image data used in the mask preview. The cached stages of the mask
+    preview are dropped if the image (or its options) changed.
+    :param settings: settings dictionary
+    :return: key (input image, modification time, image options)
+    """
+    global _preview_image_key
+    img_file = settings["inputImage"]
+    mtime = os.path.getmtime(img_file) if os.path.exists(img_file) else None
+    image_options = settings["experimentSettings"]["imageOptions"]
+    image_key = img_file, mtime, tuple(sorted(image_options.items()))
+
+    if image_key != _preview_image_key:  # the cached stages of another image (e.g. a whole cube) are not kept
+        release_preview_cache()
+        _preview_image_key = image_key
+
+    return image_key
+
+
+def preview_stage(stage, inputs, function, enabled=True, **kwargs):
+    """
+    Helper function that caches the result of a stage of the mask preview. While the settings in the mask dialog are
+    changed, a stage is only recomputed if its inputs changed (e.g. only the threshold if the slider is moved).
+    The stages are cached per calling script (module), so scripts with stages of the same name and inputs, but different
+    functions, don't share their results. The cache of the mask preview is released as soon as an image is analyzed
+    (the mask dialog is closed).
+    :param stage: name of the stage
+    :param inputs: values the result of the stage depends on (include the inputs of previous stages)
+    :param function: function computing the result of the stage
+    :param enabled: if False, the function is called without caching (analysis of images), unless the stages are
+                    shared (see shared_stages())
+    :param kwargs: keyword arguments of the function
+    :return: (cached) result of the function
+    """
+    if not enabled and _preview_cache:
+        release_preview_cache()
+
+    cache = _preview_cache if enabled else getattr(_shared_stages, "cache", None)
+    if cache is None:
+        return function(**kwargs)
+
+    key = (sys._getframe(1).f_globals.get("__name__"), stage)  # module of the calling script
+    cached = cache.get(key)
+    if cached is None or cached[0] != inputs:
+        cached = (inputs, function(**kwargs))
+        cache[key] = cached
+
+    return cached[1]
+
+
+def release_preview_cache():
+    """
+    Helper function that drops the cached stages of the mask preview (e.g. the prepared image data)
+    """
+    _preview_cache.clear()
+
+
+@contextlib.contextmanager
+def shared_stages():
+    """
+    Context manager that caches the stages of create_mask() (see preview_stage()) for the analysis of an image, e.g.
+    with shared_stages(): ... all mask variants of execute_sweep() use the same prepared image data
+    """
+    previous = getattr(_shared_stages, "cache", None)
+    _shared_stages.cache = {} if previous is None else previous
+    try:
+        yield
+    finally:
+        _shared_stages.cache = previous
+
+
+def downscale_preview(img, max_size=None):
+    """
+    Helper function that downscales an image for display in the UI
+    :param img: image
+    :param max_size: maximum size of the longer side in pixels (default: PREVIEW_MAX_SIZE, None = no downscaling)
+    :return: downscaled image
+    """
+    max_size = max_size or PREVIEW_MAX_SIZE
+    if max_size is None or max(img.shape[:2]) <= max_size:
+        return img
+
+    scale = max_size / max(img.shape[:2])
+    size = (max(round(img.shape[1] * scale), 1), max(round(img.shape[0] * scale), 1))
+
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def image_write_params(filename):
+    """
+    Helper function that returns the encoding parameters of cv2.imwrite for an image file
+    :param filename: name of the image file, the format is taken from its extension
+    :return: list of cv2.imwrite parameters
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION]
+    if extension in (".jpg", ".jpeg"):
+        return [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]
+
+    return []
+
+
+def write_image(img, filename, max_size=None):
+    """
+    Helper function that writes an image using the output settings (PNG_COMPRESSION, JPEG_QUALITY)
+    :param img: image
+    :param filename: name of the image file
+    :param max_size: maximum size of the longer side in pixels (None = full size)
+    :return: name of the image file
+    """
+    if max_size is not None:
+        img = downscale_preview(img, max_size)
+
+    if not cv2.imwrite(filename, img, image_write_params(filename)):
+        raise IOError("Error writing image " + filename)
+
+    return filename
+
+
+def process_rois(roi_items, rgb_image):  # get the rois from individual coordinates
+    # creating empty ROI object
+    rois = pcv.Objects(contours=[], hierarchy=[])
+
+    for roi_type, roi_x, roi_y, roi_width, roi_height in roi_items:
+        logger.debug("RoiItem: %s %s %s %s %s", roi_type, roi_x, roi_y, roi_width, roi_height)
+
+        if roi_type == "Circle":
+            roi_radius = int(roi_width / 2)
+            # create a single circular roi
+            roi = pcv.roi.circle(x=roi_x, y=roi_y, r=roi_radius, img=rgb_image)
+        elif roi_type == "Rectangle":
+            # create a single rectangle roi
+            logger.debug("calculated x/y %s %s", roi_x - roi_width / 2, roi_y - roi_height / 2)
+            roi = pcv.roi.rectangle(x=roi_x - roi_width / 2, y=roi_y - roi_height / 2,
+                                    h=roi_height, w=roi_width, img=rgb_image)
+
+        else:
+            warnings.warn("Roi type is neither circle or rectangle")
+            break
+
+        # append the roi contour and hierarchy to the object collecting all the rois
+        rois.append(roi.contours, roi.hierarchy)
+
+    return rois
+
+
+def label_rois(roi_items, mask):
+    """
+    Fast replacement for process_rois() followed by pcv.create_labels(mask=mask, rois=rois, roi_type="partial") with
+    the same result. The contours are filtered by the same rules as PlantCV (an object is kept if its filled outline
+    overlaps the filled ROI, later ROIs are drawn over earlier ones), but each ROI only processes the region of the
+    contours it keeps instead of the whole image.
+    :param roi_items: ROI items from the settings dictionary
+    :param mask: binary mask
+    :return: labeled mask (label i = objects in ROI i), number of labels (= ROIs)
+    """
+    roi_masks = get_roi_masks(roi_items, mask.shape[:2])
+    labeled_mask = np.zeros(mask.shape[:2], dtype=np.int32)
+    contours, hierarchy = cv2.findContours(np.copy(mask), cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[-2:]
+    if not contours:
+        return labeled_mask, len(roi_masks)
+
+    # outline points of all contours and the contour they belong to
+    lengths = [len(contour) for contour in contours]
+    points = np.concatenate(contours)[:, 0, :]
+    point_contours = np.repeat(np.arange(len(contours)), lengths)
+    # bounding boxes of the contours (x0, y0, x1, y1), nothing is drawn outside of them
+    starts = np.cumsum([0] + lengths[:-1])
+    boxes = np.hstack([np.minimum.reduceat(points, starts), np.maximum.reduceat(points, starts) + 1])
+    height, width = mask.shape[:2]
+
+    for i, (roi_box, roi_mask) in enumerate(roi_masks):
+        # the outline is part of the filled contour, so they overlap if it touches the ROI
+        roi_points = points - roi_box[:2]
+        in_box = np.all((roi_points >= 0) & (roi_points < roi_mask.shape[::-1]), axis=1)
+        in_roi = np.zeros(len(points), dtype=bool)
+        in_roi[in_box] = roi_mask[roi_points[in_box, 1], roi_points[in_box, 0]] > 0
+        kept = np.bincount(point_contours[in_roi], minlength=len(contours)) > 0
+        # otherwise, the filled contour can only overlap the ROI if it surrounds the whole ROI
+        surrounding = ~kept & np.all(boxes[:, :2] <= roi_box[:2], axis=1) & np.all(boxes[:, 2:] >= roi_box[2:], axis=1)
+        for c in np.nonzero(surrounding)[0]:
+            kept[c] = filled_contour_overlaps_roi(contours[c], boxes[c], roi_box, roi_mask)
+        # PlantCV draws all objects and deletes the contours that don't overlap the ROI. The objects (outer contours and
+        # everything nested in them) don't overlap each other, so only the kept ones are drawn here, into their region
+        # (with a margin of one pixel), and the nested contours that don't overlap the ROI (e.g. holes) are deleted.
+        roots = np.nonzero(kept & (hierarchy[0][:, 3] == -1))[0]
+        if len(roots) == 0:
+            continue
+        x0, y0 = (int(value) for value in np.maximum(boxes[roots, :2].min(axis=0) - 1, 0))
+        x1, y1 = (int(value) for value in np.minimum(boxes[roots, 2:].max(axis=0) + 1, [width, height]))
+        roi_objects = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        trees = [nested_contours(hierarchy, int(root)) for root in roots]
+        draw_contour_trees(roi_objects, contours, hierarchy, trees, 255, (-x0, -y0))
+        for tree in trees:
+            for c in tree[1:]:
+                if not kept[c]:
+                    draw_contour_trees(roi_objects, contours, hierarchy, [nested_contours(hierarchy, c)], 0, (-x0, -y0))
+        kept_contours = cv2.findContours(roi_objects, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[-2]
+
+        roi_labels = labeled_mask[y0:y1, x0:x1].copy()
+        cv2.drawContours(roi_labels, kept_contours, -1, i + 1, -1)
+        labeled_mask[y0:y1, x0:x1] = roi_labels
+
+    return labeled_mask, len(roi_masks)
+
+
+def get_roi_masks(roi_items, shape):
+    """
+    Helper function that creates the ROIs with process_rois() and fills them the same way as PlantCV. The filled ROIs
+    are cached for all images with the same ROI layout and size.
+    :param roi_items: ROI items from the settings dictionary
+    :param shape: image shape (lines, samples)
+    :return: list with the bounding box (x0, y0, x1, y1) and the filled ROI inside of it (uint8 image) of each ROI
+    """
+    key = (tuple(tuple(roi_item) for roi_item in roi_items), tuple(shape))
+    if key not in _roi_mask_cache:
+        roi_masks = []
+        for roi_contour in process_rois(roi_items, np.zeros(shape, dtype=np.uint8)).contours:
+            roi_mask = np.zeros(shape, dtype=np.uint8)
+            cv2.fillPoly(roi_mask, [np.vstack(roi_contour[0])], 255)
+            rows, cols = np.nonzero(roi_mask.any(axis=1))[0], np.nonzero(roi_mask.any(axis=0))[0]
+            if len(rows) == 0:  # empty ROI
+                roi_masks.append((np.zeros(4, dtype=int), roi_mask[:0, :0]))
+                continue
+            roi_box = np.array([cols[0], rows[0], cols[-1] + 1, rows[-1] + 1])
+            roi_masks.append((roi_box, roi_mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].copy()))
+
+        if len(_roi_mask_cache) >= 8:  # only keep a few layouts
+            _roi_mask_cache.clear()
+        _roi_mask_cache[key] = roi_masks
+
+    return _roi_mask_cache[key]
+
+
+def nested_contours(hierarchy, index):
+    """
+    Helper function that finds the contours nested in a contour (e.g. its holes and the objects inside of them)
+    :param hierarchy: hierarchy from cv2.findContours (RETR_TREE)
+    :param index: index of the contour
+    :return: indices of the contour and all contours nested in it
+    """
+    tree = [index]
+    for c in tree:  # the list grows while the children are added
+        child = hierarchy[0][c][2]
+        while child != -1:
+            tree.append(int(child))
+            child = hierarchy[0][child][0]
+
+    return tree
+
+
+def draw_contour_trees(img, contours, hierarchy, trees, color, offset):
+    """
+    Helper function that fills contours and the contours nested in them, the same as calling
+    cv2.drawContours(img, contours, tree[0], color, -1, lineType=8, hierarchy=hierarchy) for each tree (the trees
+    don't overlap), but only the contours of the trees are passed to OpenCV
+    :param img: image the contours are drawn into (changed in place)
+    :param contours: contours from cv2.findContours (RETR_TREE)
+    :param hierarchy: hierarchy from cv2.findContours
+    :param trees: list of indices of a contour and the contours nested in it, see nested_contours()
+    :param color: color
+    :param offset: offset of the contour points, e.g. (-x0, -y0) if img is a region starting at x0, y0
+    """
+    indices = [c for tree in trees for c in tree]
+    positions = {c: position for position, c in enumerate(indices)}
+    tree_hierarchy = np.array([[[positions.get(int(value), -1) for value in hierarchy[0][c]] for c in indices]],
+                              dtype=np.int32)
+    for tree in trees:  # the trees are drawn on their own: no siblings and no parent
+        root = positions[tree[0]]
+        tree_hierarchy[0][root] = [-1, -1, tree_hierarchy[0][root][2], -1]
+
+    cv2.drawContours(img, [contours[c] for c in indices], -1, color, -1, lineType=8, hierarchy=tree_hierarchy,
+                     offset=offset)
+
+
+def filled_contour_overlaps_roi(contour, box, roi_box, roi_mask):
+    """
+    Helper function that checks if the filled contour overlaps the filled ROI (same test as _roi_filter() of PlantCV,
+    but the contour is only drawn inside of its bounding box)
+    :param contour: contour of an object
+    :param box: bounding box of the contour (x0, y0, x1, y1), containing the bounding box of the ROI
+    :param roi_box: bounding box of the ROI (x0, y0, x1, y1)
+    :param roi_mask: filled ROI inside of its bounding box
+    :return: True if they overlap
+    """
+    filled = np.zeros((box[3] - box[1], box[2] - box[0]), dtype=np.uint8)
+    cv2.fillPoly(filled, [contour], 255, offset=(-int(box[0]), -int(box[1])))
+    filled = filled[roi_box[1] - box[1]:roi_box[3] - box[1], roi_box[0] - box[0]:roi_box[2] - box[0]]
+
+    return bool(np.any(filled & roi_mask))
+
+
+def roi_statistics(labeled_objects, n_obj, index_img=None):
+    """
+    Helper function that computes shape parameters and index statistics of all labels. The shape parameters follow
+    pcv.analyze.size, but only the bounding box of each label is processed: area (pixels), perimeter (cv2.arcLength of
+    the stacked contours), width and height (cv2.boundingRect). Like in PlantCV, objects with 5 or fewer contour points
+    are not analyzed (all values 0) and the values are scaled by pcv.params.px_width and px_height.
+    :param labeled_objects: labeled mask (0 = background, 1 to n_obj = objects in the respective ROI)
+    :param n_obj: number of labels
+    :param index_img: index image (2d array or PlantCV spectral data object), None skips the index statistics
+    :return: dictionary of columns (numpy arrays, entry i - 1 belongs to label i): area, width, height, perimeter,
+             mean, median, std (of the finite index values)
+    """
+    labels = np.asarray(labeled_objects).astype(np.int32, copy=False)
+    roi_stats = {column: np.zeros(n_obj) for column in ("area", "width", "height", "perimeter")}
+
+    for i, box in enumerate(ndimage.find_objects(labels, max_label=n_obj)):
+        if box is None:  # no objects in the ROI
+            continue
+        # bounding box with a margin of one pixel, the contours are the same as in the whole image
+        rows = slice(max(box[0].start - 1, 0), box[0].stop + 1)
+        cols = slice(max(box[1].start - 1, 0), box[1].stop + 1)
+        submask = np.where(labels[rows, cols] == i + 1, 255, 0).astype(np.uint8)
+        contours, hierarchy = cv2.findContours(submask, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[-2:]
+
+        # same as _object_composition of PlantCV: contours of holes without objects inside are left out
+        obj = [contour for contour, (_, _, child, parent) in zip(contours, hierarchy[0]) if child != -1 or parent == -1]
+        if sum(len(contour) for contour in obj) > 5:  # PlantCV only analyzes objects with more than 5 contour points
+            obj = np.vstack(obj)
+            roi_stats["area"][i] = cv2.moments(submask, binaryImage=True)["m00"]
+            roi_stats["perimeter"][i] = cv2.arcLength(obj, closed=True)
+            roi_stats["width"][i], roi_stats["height"][i] = cv2.boundingRect(obj)[2:]
+
+    # pixel size (same as _scale_size of PlantCV)
+    roi_stats["area"] *= pcv.params.px_width * pcv.params.px_height
+    for column in ("width", "height", "perimeter"):
+        roi_stats[column] *= pcv.params.px_width
+
+    # index statistics
+    index_stats = IndexStatistics(n_obj)
+    if index_img is not None:
+        index_stats.add(labels, index_img)
+    roi_stats.update(index_stats.result())
+
+    return roi_stats
+
+
+class IndexStatistics:
+    """
+    Collects the index values of the labeled pixels, e.g. tile by tile, and computes the statistics of each label.
+    Only the finite values inside of the labels are kept (not the index images).
+    """
+    def __init__(self, n_obj):
+        self.n_obj = n_obj
+        self._labels = []
+        self._values = []
+
+    def add(self, labeled_objects, index_img):
+        """
+        :param labeled_objects: labeled mask (or the rows of it belonging to the index image)
+        :param index_img: index image (2d array or PlantCV spectral data object), None is ignored
+        """
+        if index_img is None:  # index could not be computed
+            return
+        labels = np.asarray(labeled_objects).ravel()
+        index_values = np.asarray(getattr(index_img, "array_data", index_img)).ravel()
+        valid = (labels > 0) & np.isfinite(index_values)
+        self._labels.append(labels[valid].astype(np.int32, copy=False))
+        self._values.append(index_values[valid])
+
+    def result(self):
+        """
+        :return: dictionary of columns (numpy arrays, entry i - 1 belongs to label i): mean, median, std
+        """
+        n_obj = self.n_obj
+        n_bins = n_obj + 1
+        index_stats = {"mean": np.full(n_obj, np.nan), "median": np.full(n_obj, np.nan), "std": np.full(n_obj, np.nan)}
+        if not self._values:
+            return index_stats
+
+        values = np.concatenate(self._values).astype(np.float64)
+        value_labels = np.concatenate(self._labels)
+
+        count = np.bincount(value_labels, minlength=n_bins)[1:n_bins]
+        analyzed = count > 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.bincount(value_labels, weights=values, minlength=n_bins)[1:n_bins] / count
+            deviation = (values - mean[value_labels - 1]) ** 2
+            std = np.sqrt(np.bincount(value_labels, weights=deviation, minlength=n_bins)[1:n_bins] / count)
+
+        index_stats["mean"][analyzed] = mean[analyzed]
+        index_stats["std"][analyzed] = std[analyzed]
+        if analyzed.any():
+            analyzed_labels = np.nonzero(analyzed)[0] + 1
+            index_stats["median"][analyzed] = ndimage.median(values, value_labels, analyzed_labels)
+
+        return index_stats
+
+
+def tiled_index_statistics(spectral_array, name, labeled_objects, n_obj, distance=10):
+    """
+    Helper function that computes an index and its statistics per label in tiles of rows (see index_tiles())
+    :param spectral_array: spectral data (PlantCV or LazySpectralData object)
+    :param name: name of the index (key in INDEX_FUNCTIONS)
+    :param labeled_objects: labeled mask
+    :param n_obj: number of labels
+    :param distance: how lenient to be if the required wavelengths are not available
+    :return: dictionary of columns (numpy arrays, entry i - 1 belongs to label i): mean, median, std
+    """
+    return index_statistics_per_mask(spectral_array, name, [(labeled_objects, n_obj)], distance)[0]
+
+
+def index_statistics_per_mask(spectral_array, name, labeled_masks, distance=10):
+    """
+    Helper function that computes an index once (in tiles of rows, see index_tiles()) and its statistics per label for
+    several labeled masks of the same image
+    :param spectral_array: spectral data (PlantCV or LazySpectralData object)
+    :param name: name of the index (key in INDEX_FUNCTIONS)
+    :param labeled_masks: list of (labeled mask, number of labels)
+    :param distance: how lenient to be if the required wavelengths are not available
+    :return: list with the statistics of each labeled mask, see tiled_index_statistics()
+    """
+    labels = [np.asarray(labeled_objects) for labeled_objects, _ in labeled_masks]
+    index_stats = [IndexStatistics(n_obj) for _, n_obj in labeled_masks]
+    for rows, index_tile in index_tiles(spectral_array, name, distance):
+        for mask_labels, mask_stats in zip(labels, index_stats):
+            mask_stats.add(mask_labels[rows], index_tile)
+
+    return [mask_stats.result() for mask_stats in index_stats]
+
+
+def index_tiles(spectral_array, name, distance=10, budget=None):
+    """
+    Generator that computes an index in tiles of rows. The number of rows per tile is chosen so that the bands and
+    intermediate results of a tile fit into the memory budget. With LAZY_LOADING, only the rows of the current tile
+    are read (and undistorted). Images that fit into a single tile are computed by the (cached) index evaluator.
+    :param spectral_array: spectral data (PlantCV or LazySpectralData object)
+    :param name: name of the index (key in INDEX_FUNCTIONS)
+    :param distance: how lenient to be if the required wavelengths are not available
+    :param budget: memory budget in bytes (default: TILE_MEMORY_BUDGET)
+    :return: rows (slice), index image of the rows (PlantCV spectral data object or None)
+    """
+    lines = spectral_array.array_data.shape[0]
+    rows_per_tile = tile_rows(spectral_array.array_data.shape[1], lines, budget or TILE_MEMORY_BUDGET)
+
+    if rows_per_tile >= lines:
+        yield slice(None), get_index_evaluator(spectral_array).index(name, distance)
+        return
+
+    for start in range(0, lines, rows_per_tile):
+        rows = slice(start, min(start + rows_per_tile, lines))
+        yield rows, INDEX_FUNCTIONS[name][1](spectral_tile(spectral_array, rows), distance)
+
+
+def tile_rows(samples, lines, budget, bytes_per_pixel=48):
+    """
+    Helper function that determines the number of rows of a tile
+    :param samples: image width
+    :param lines: image height
+    :param budget: memory budget in bytes (None = whole image)
+    :param bytes_per_pixel: memory used per pixel (bands read by an index function and its float32/float64
+                            intermediate results)
+    :return: number of rows per tile
+    """
+    if budget is None:
+        return lines
+
+    return max(int(budget // (samples * bytes_per_pixel)), 1)
+
+
+def spectral_tile(spectral_array, rows):
+    """
+    Helper function that creates a spectral data object of a tile of rows, its bands are only read for these rows
+    :param spectral_array: spectral data (PlantCV or LazySpectralData object)
+    :param rows: rows of the tile (slice)
+    :return: spectral data object of the tile
+    """
+    tile = copy.copy(spectral_array)
+    tile.array_data = TileCube(spectral_array.array_data, rows)
+    tile.lines = tile.array_data.shape[0]
+    tile.index_evaluator = None  # the evaluator of the image does not apply to the tile
+
+    return tile
+
+
+class TileCube:
+    """
+    Cube-like view on a tile of rows of a data cube (lines x samples x bands), e.g. tile[:, :, i] reads band i of the
+    tile rows only
+    """
+    def __init__(self, cube, rows):
+        self.cube = cube
+        self.rows = rows
+        self.shape = (len(range(*rows.indices(cube.shape[0]))),) + tuple(cube.shape[1:])
+        self.dtype = cube.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        tile = np.asarray(self.cube[self.rows])
+        return tile if dtype is None else tile.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if isinstance(key[0], slice) and key[0] == slice(None) and not any(item is Ellipsis for item in key):
+            return self.cube[(self.rows,) + key[1:]]
+
+        return np.asarray(self)[key]
+
+    def astype(self, dtype):
+        return np.asarray(self).astype(dtype)
+
+
+def get_index_evaluator(spectral_array):
+    """
+    Helper function that returns the index evaluator of an image. The evaluator is kept with the spectral data, so
+    all indices computed for the same image share its cache.
+    :param spectral_array: spectral data (PlantCV or LazySpectralData object)
+    :return: IndexEvaluator
+    """
+    evaluator = getattr(spectral_array, "index_evaluator", None)
+    if evaluator is None:
+        evaluator = IndexEvaluator(spectral_array)
+        spectral_array.index_evaluator = evaluator
+
+    return evaluator
+
+
+class IndexEvaluator:
+    """
+    Computes spectral indices (INDEX_FUNCTIONS) of one image. The bands read by the index functions and the index
+    images are kept in an LRU cache limited by CACHE_BUDGET, so bands shared between indices are only extracted once
+    and indices that were already computed are returned from the cache.
+    """
+    def __init__(self, spectral_array, max_bytes=None):
+        self.cache = ArrayCache(max_bytes or CACHE_BUDGET)
+        self.spectral_array = copy.copy(spectral_array)
+        if isinstance(spectral_array.array_data, np.ndarray):  # LazyDataCube already caches its bands
+            self.spectral_array.array_data = BandCachingCube(spectral_array.array_data, self.cache)
+
+    def index(self, name, distance=10):
+        """
+        :param name: name of the index (key in INDEX_FUNCTIONS)
+        :param distance: how lenient to be if the required wavelengths are not available
+        :return: index image (PlantCV spectral data object)
+        """
+        key = ("index", name, distance)
+        if key not in self.cache:
+            return self.cache.put(key, INDEX_FUNCTIONS[name][1](self.spectral_array, distance))
+        return self.cache.get(key)
+
+    def indices(self, names, distance=10):
+        """
+        Computes several indices in one pass, each band is only extracted once for all of them
+        :param names: names of the indices
+        :param distance: how lenient to be if the required wavelengths are not available
+        :return: dictionary of name: index image
+        """
+        return {name: self.index(name, distance) for name in names}
+
+
+class BandCachingCube:
+    """
+    Wrapper around a data cube (lines x samples x bands) that keeps single bands (cube[:, :, i]) in a shared cache as
+    contiguous arrays. Any other indexing is passed on to the cube.
+    """
+    def __init__(self, cube, cache):
+        self.cube = cube
+        self.cache = cache
+        self.shape = cube.shape
+        self.dtype = cube.dtype
+        self.ndim = cube.ndim
+
+    def __len__(self):
+        return len(self.cube)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.cube if dtype is None else self.cube.astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) == 3 and isinstance(key[2], (int, np.integer)) and \
+                all(isinstance(item, slice) and item == slice(None) for item in key[:2]):
+            band = int(key[2]) % self.shape[2]
+            if ("band", band) not in self.cache:
+                return self.cache.put(("band", band), np.ascontiguousarray(self.cube[:, :, band]))
+            return self.cache.get(("band", band))
+
+        return self.cube[key]
+
+    def astype(self, dtype):
+        return self.cube.astype(dtype)
+
+
+def create_results_table(n_obj, fields, text_values=None):
+    """
+    Helper function that preallocates the results table
+    :param n_obj: number of labels in the labeled mask (= ROIs)
+    :param fields: fields of the results (RESULTS_FIELDS of the analysis script), "roi" is required
+    :param text_values: dictionary of text field: string filled into all rows (e.g. {"index": "ndvi"}), the field is
+    widened if the string is longer than defined in fields
+    :return: results table (numpy structured array with the columns of fields, row i - 1 belongs to label i)
+    """
+    text_values = text_values or {}
+    results_table = np.zeros(n_obj, dtype=widen_text_fields(np.dtype(fields), {
+        name: len(value) for name, value in text_values.items()}))
+    for name in results_table.dtype.names:
+        if results_table.dtype[name].kind == "f":
+            results_table[name] = np.nan  # not analyzed
+    results_table["roi"] = np.arange(1, n_obj + 1)
+    for name, value in text_values.items():
+        results_table[name] = value
+
+    return results_table
+
+
+def widen_text_fields(dtype, widths):
+    """
+    Helper function that widens the text fields of a structured data type, numpy silently truncates longer strings
+    :param dtype: structured data type
+    :param widths: dictionary of field name: required number of characters
+    :return: data type with text fields at least as wide as required (dtype if no field had to be widened)
+    """
+    fields = [(name, f"U{max(dtype[name].itemsize // 4, widths.get(name, 0))}") if dtype[name].kind == "U"
+              else (name, dtype[name]) for name in dtype.names]
+    widened = np.dtype(fields)
+
+    return dtype if widened == dtype else widened
+
+
+def fill_results_table(results_table, observations, observation_keys, label="plant"):
+    """
+    Helper function that copies the values of PlantCV observations into the results table
+    :param results_table: results table from create_results_table()
+    :param observations: PlantCV observations (pcv.outputs.observations)
+    :param observation_keys: dictionary of results field: observation name
+    :param label: label used in the PlantCV analysis functions
+    """
+    for row, roi in enumerate(results_table["roi"]):
+        roi_results = observations.get(f"{label}_{roi}", {})
+        for field, key in observation_keys.items():
+            if key in roi_results:
+                results_table[field][row] = roi_results[key]["value"]
+
+
+def results_table_to_list(results_table):
+    """
+    Helper function that converts the results table into the list of dictionaries signalled to the feedback queue
+    :param results_table: results table from create_results_table()
+    :return: list with one dictionary per ROI, missing values are None
+    """
+    names = results_table.dtype.names
+
+    return [{name: (None if isinstance(value, float) and np.isnan(value) else value)
+             for name, value in zip(names, row)} for row in results_table.tolist()]
+
+
+def get_results_store(folder, fields):
+    """
+    Helper function that returns the results store of this process (created when it is first used, worker processes
+    of run_batch() append to their own chunks)
+    :param folder: folder of the results store (RESULTS_STORE_DIR of the analysis script)
+    :param fields: fields of the results (RESULTS_FIELDS of the analysis script)
+    :return: ResultsStore or None if folder is None
+    """
+    if folder is None:
+        return None
+
+    key = (os.getpid(), folder, np.dtype(fields))
+    if key not in _results_stores:
+        _results_stores.clear()  # forked worker processes must not append to the chunk of their parent
+        _results_stores[key] = ResultsStore(folder, fields)
+
+    return _results_stores[key]
+
+
+class ResultsStore:
+    """
+    Append-only table of the per-ROI results of all images on disk. The rows are numpy structured arrays with the
+    columns of the results table plus the time (UTC) and name of the image. They are appended to chunk files of raw
+    records, each with a JSON file holding its data type, number of rows and time range. A chunk is only written by
+    one process and read as memory map, so read() only loads the rows of the requested time range, e.g.
+    ResultsStore(RESULTS_STORE_DIR, RESULTS_FIELDS).read(start, end, fields=("time", "roi", "plot_value"))
+    Text fields (the image name and e.g. the index) are widened if a longer string is appended, the following rows are
+    appended to a new chunk with the wider data type.
+    """
+    def __init__(self, folder, fields, chunk_rows=None):
+        self.folder = folder
+        self.dtype = np.dtype([("time", "datetime64[ms]"), ("image", "U64")] + list(fields))
+        self.chunk_rows = chunk_rows or RESULTS_CHUNK_ROWS
+        self._chunk = None  # info of the chunk the results are appended to
+        self._n_chunks = 0
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def append(self, results_table, image_name, image_time=None):
+        """
+        Appends the results of an image
+        :param results_table: results table from create_results_table()
+        :param image_name: name of the image
+        :param image_time: time of the image (seconds since the epoch, datetime or datetime64, default: now)
+        """
+        widths = {name: results_table.dtype[name].itemsize // 4 for name in results_table.dtype.names
+                  if results_table.dtype[name].kind == "U"}
+        widths["image"] = len(image_name)
+
+        with self._lock:
+            dtype = widen_text_fields(self.dtype, widths)
+            if dtype != self.dtype:  # a chunk has a single data type, the wider rows start a new one
+                self.dtype = dtype
+                self._chunk = None
+
+            rows = np.zeros(len(results_table), dtype=self.dtype)
+            rows["time"] = np.datetime64(self._time_ms(time.time() if image_time is None else image_time), "ms")
+            rows["image"] = image_name
+            for name in results_table.dtype.names:
+                if name in self.dtype.names:
+                    rows[name] = results_table[name]
+
+            if self._chunk is None or 0 < self._chunk["rows"] and self._chunk["rows"] + len(rows) > self.chunk_rows:
+                self._chunk = self._new_chunk()
+            chunk = self._chunk
+
+            with open(os.path.join(self.folder, chunk["file"]), "ab") as file:
+                file.write(rows.tobytes())
+
+            if len(rows):
+                row_time = int(rows["time"][0].astype(np.int64))
+                chunk["start"] = row_time if chunk["start"] is None else min(chunk["start"], row_time)
+                chunk["end"] = row_time if chunk["end"] is None else max(chunk["end"], row_time)
+                chunk["rows"] += len(rows)
+            self._write_info(chunk)  # the rows are only read after they are written completely
+
+    def read(self, start=None, end=None, fields=None, rois=None):
+        """
+        Reads the results of a time range
+        :param start: first time read (seconds since the epoch, datetime or datetime64, default: first image)
+        :param end: end of the time range, not included (same types as start, default: last image)
+        :param fields: names of the columns read (default: all)
+        :param rois: list of the ROIs read (default: all)
+        :return: structured array of the rows sorted by time, columns missing in older chunks are empty (NaN)
+        """
+        start = None if start is None else self._time_ms(start)
+        end = None if end is None else self._time_ms(end)
+        chunks = [chunk for chunk in self.chunks() if chunk["rows"] > 0 and (start is None or chunk["end"] >= start) and
+                  (end is None or chunk["start"] < end)]
+
+        # text fields as wide as in the widest chunk read (see append())
+        widths = {}
+        for name, field_type in (field[:2] for chunk in chunks for field in chunk["dtype"]):
+            if np.dtype(field_type).kind == "U":
+                widths[name] = max(widths.get(name, 0), np.dtype(field_type).itemsize // 4)
+        dtype = widen_text_fields(self.dtype, widths)
+        dtype = dtype if fields is None else np.dtype([(name, dtype[name]) for name in fields])
+
+        parts = []
+        for chunk in chunks:
+            records = np.memmap(os.path.join(self.folder, chunk["file"]), mode="r", shape=(chunk["rows"],),
+                                dtype=np.dtype([tuple(field) for field in chunk["dtype"]]))
+            selected = np.ones(len(records), dtype=bool)
+            if start is not None or end is not None:
+                times = records["time"].astype(np.int64)
+                if start is not None:
+                    selected &= times >= start
+                if end is not None:
+                    selected &= times < end
+            if rois is not None:
+                selected &= np.isin(records["roi"], rois)
+            selected = np.flatnonzero(selected)
+
+            part = np.zeros(len(selected), dtype=dtype)
+            for name in dtype.names:
+                if name in records.dtype.names:
+                    part[name] = records[name][selected]
+                elif dtype[name].kind == "f":
+                    part[name] = np.nan
+            parts.append(part)
+
+        if not parts:
+            return np.zeros(0, dtype=dtype)
+
+        results = np.concatenate(parts)
+        if "time" in dtype.names:
+            results = results[np.argsort(results["time"], kind="stable")]
+
+        return results
+
+    def chunks(self):
+        """
+        :return: list of the infos of all chunks (file, dtype, rows, start and end time in ms since the epoch)
+        """
+        chunks = []
+        for info_file in sorted(glob.glob(os.path.join(self.folder, "results_*.json"))):
+            try:
+                with open(info_file) as file:
+                    chunks.append(json.load(file))
+            except (OSError, ValueError):  # chunk created just now
+                continue
+
+        return chunks
+
+    def _new_chunk(self):
+        self._n_chunks += 1
+        name = f"results_{time.time_ns() // 1000000}_{os.getpid()}_{self._n_chunks}"
+        return {"file": name + ".bin", "dtype": self.dtype.descr, "rows": 0, "start": None, "end": None}
+
+    def _write_info(self, chunk):
+        info_file = os.path.join(self.folder, os.path.splitext(chunk["file"])[0] + ".json")
+        with open(info_file + ".tmp", "w") as file:
+            json.dump(chunk, file)
+        os.replace(info_file + ".tmp", info_file)
+
+    @staticmethod
+    def _time_ms(value):
+        if isinstance(value, (int, float, np.integer, np.floating)):
+            return int(round(value * 1000))
+        return int(np.datetime64(value, "ms").astype(np.int64))
+
+
+def get_image_writer():
+    """
+    Helper function that returns the image writer of this process (created when it is first used, worker processes
+    of run_batch() get their own writer)
+    :return: ImageWriter
+    """
+    pid = os.getpid()
+    if pid not in _image_writers:
+        _image_writers.clear()  # writer threads are not inherited by forked worker processes
+        _image_writers[pid] = ImageWriter()
+
+    return _image_writers[pid]
+
+
+class ImageWriter:
+    """
+    Writes images in background threads, so the next image can be processed while the previous one is encoded.
+    At most max_pending images wait to be written, write() blocks if there are more (limits the memory used).
+    """
+    def __init__(self, threads=None, max_pending=None):
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads or WRITER_THREADS,
+                                                               thread_name_prefix="image_writer")
+        self._slots = threading.BoundedSemaphore(max_pending or WRITER_QUEUE_SIZE)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._folders = set()  # output folders that already exist
+
+    def write(self, img, filename, max_size=None, callback=None, metrics=None):
+        """
+        Writes an image in the background
+        :param img: image (must not be changed afterwards)
+        :param filename: name of the image file, its folder is created if required
+        :param max_size: maximum size of the longer side in pixels (None = full size)
+        :param callback: function called with the file name as soon as the image was written
+        :param metrics: ImageMetrics of the image, the time of writing is added as stage "write" and its part "image"
+                        is done afterwards
+        :return: future of the written file name
+        """
+        path = os.path.dirname(filename)
+        if path not in self._folders:
+            if path and not os.path.exists(path):
+                os.makedirs(path, exist_ok=True)
+                logger.info("created folder %s", path)
+            self._folders.add(path)
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._write, img, filename, max_size, callback, metrics)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+        return future
+
+    def flush(self):
+        """
+        Waits until all images submitted so far are written (and their callbacks are done)
+        """
+        with self._lock:
+            pending = list(self._pending)
+        concurrent.futures.wait(pending)
+
+    def _write(self, img, filename, max_size, callback, metrics):
+        try:
+            start = time.perf_counter()
+            write_image(img, filename, max_size)
+            if metrics is not None:
+                metrics.add("write", time.perf_counter() - start)
+            if callback is not None:
+                callback(filename)
+        finally:
+            self._slots.release()
+            if metrics is not None:
+                metrics.done("image")
+
+        return filename
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        if future.exception() is not None:
+            logger.error("Error writing image: %s", future.exception())
+
+
+def start_image_metrics(feedback_queue, script_name):
+    """
+    Helper function that starts collecting the metrics of an image processed by execute()
+    :param feedback_queue: queue of feedback messages
+    :param script_name: name of the analysis script (required for feedback queue)
+    :return: ImageMetrics
+    """
+    previous = current_metrics()
+    if previous is not None and previous.profiler is not None:  # processing of the previous image failed
+        previous.profiler.disable()
+
+    metrics = ImageMetrics(feedback_queue, script_name, parts=("workflow", "image"))
+    if PROFILE_DIR is not None:
+        metrics.profiler = cProfile.Profile()
+        metrics.profiler.enable()
+    set_current_metrics(metrics)
+
+    return metrics
+
+
+def finish_image_metrics(metrics, image_file_name):
+    """
+    Helper function that finishes the metrics of the workflow of an image. The profile is dumped to PROFILE_DIR if the
+    image took PROFILE_OUTLIER_FACTOR times longer than the median of the previous images.
+    :param metrics: ImageMetrics from start_image_metrics()
+    :param image_file_name: name of the processed image
+    """
+    metrics.total = time.perf_counter() - metrics.start_time
+    metrics.image_file_name = image_file_name
+    set_current_metrics(None)
+
+    if metrics.profiler is not None:
+        metrics.profiler.disable()
+        if len(_execute_times) >= 5 and metrics.total > PROFILE_OUTLIER_FACTOR * statistics.median(_execute_times):
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            image_name = os.path.splitext(os.path.basename(image_file_name))[0]
+            metrics.profile_file = os.path.join(PROFILE_DIR, f"{image_name}_{int(time.time() * 1000)}.prof")
+            metrics.profiler.dump_stats(metrics.profile_file)
+            logger.warning("Processing took %.2f s, profile written to %s", metrics.total, metrics.profile_file)
+        metrics.profiler = None
+
+    _execute_times.append(metrics.total)
+    metrics.done("workflow")
+
+
+def peak_memory_mb():
+    """
+    Helper function that returns the peak resident memory of this process
+    :return: peak memory in MB, None if it can't be determined
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10  # bytes on macOS, kB on Linux
+    except ImportError:  # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 2 ** 20
+        except (ImportError, AttributeError):
+            return None
+
+
+class ImageMetrics:
+    """
+    Collects the time spent in each stage of processing an image, the bytes read from the image file and the peak
+    memory. Stages are either timed with stage() (can be nested, the time of a nested stage is not counted for the
+    enclosing stage) or by checkpoint(), which records the time since the previous checkpoint.
+    The metrics are signalled as 'metrics' message as soon as all parts of the processing are done().
+    """
+    def __init__(self, feedback_queue, script_name, parts=("workflow",)):
+        self.feedback_queue = feedback_queue
+        self.script_name = script_name
+        self.stages = {}  # stage: seconds
+        self.bytes_read = 0
+        self.total = None
+        self.image_file_name = None
+        self.profiler = None
+        self.profile_file = None
+        self.start_time = time.perf_counter()
+        self._stack = [[None, self.start_time, 0.0]]  # running stages: [name, start time, time before nested stages]
+        self._pending = set(parts)
+        self._lock = threading.Lock()
+        self._thread = threading.get_ident()  # thread processing the image
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if threading.get_ident() != self._thread:  # stages of helper threads are counted for the calling stage
+            yield
+            return
+
+        now = time.perf_counter()
+        parent = self._stack[-1]
+        parent[2] += now - parent[1]
+        self._stack.append([name, now, 0.0])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            _, start, elapsed = self._stack.pop()
+            self.add(name, elapsed + now - start)
+            self._stack[-1][1] = now
+
+    def checkpoint(self, name):
+        """
+        Records the time since the previous checkpoint (without the time of the stages timed in between) as stage
+        """
+        now = time.perf_counter()
+        root = self._stack[0]
+        self.add(name, root[2] + now - root[1])
+        root[1] = now
+        root[2] = 0.0
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_bytes(self, n_bytes):
+        with self._lock:
+            self.bytes_read += n_bytes
+
+    def done(self, part):
+        """
+        Marks a part of the processing as finished, the metrics are signalled once all parts are finished
+        :param part: name of the part (e.g. "workflow" or "image")
+        """
+        with self._lock:
+            self._pending.discard(part)
+            finished = not self._pending
+
+        if finished:
+            logger.info("Metrics: %s", ", ".join(f"{name} {seconds:.3f} s" for name, seconds in self.stages.items()))
+            if SIGNAL_METRICS:
+                self.feedback_queue.put([self.script_name, 'metrics', self.summary()])
+
+    def summary(self):
+        """
+        :return: dictionary of the metrics
+        """
+        with self._lock:
+            return {"imageFileName": self.image_file_name,
+                    "stages": dict(self.stages),
+                    "total": self.total,
+                    "bytesRead": self.bytes_read,
+                    "peakMemoryMB": peak_memory_mb(),
+                    "profile": self.profile_file}
+
+
+def run_batch(execute_function, feedback_queue, script_name, settings, mask_file_name, image_files, processes=None,
+              max_pending=None):
+    """
+    Runs the execute() function of an analysis script for a list of images in a pool of worker processes. Workers are
+    reused for all images, so PlantCV, the analysis script and the mask script stay imported between images.
+    :param execute_function: execute() of the analysis script (imported by the workers by its module name)
+    :param feedback_queue: queue of feedback messages
+    :param script_name: name of the analysis script (required for feedback queue)
+    :param settings: settings dictionary, "inputImage" is replaced with each of the image files
+    :param mask_file_name: name of the mask script (required for feedback queue)
+    :param image_files: list of .hdr files or glob pattern (e.g. "C:/images/*.hdr")
+    :param processes: number of worker processes (default: number of CPUs)
+    :param max_pending: maximum number of images submitted to the pool at the same time, limits the number of images
+                        (and their results) held in memory (default: 2 x processes)
+    """
+    if isinstance(image_files, str):
+        image_files = sorted(glob.glob(image_files))
+
+    processes = processes or os.cpu_count() or 1
+    max_pending = max(max_pending or 2 * processes, 1)
+
+    pending = collections.deque()
+    with _create_batch_pool(execute_function, processes, mask_file_name) as pool:
+        for image_file in image_files:
+            image_settings = dict(settings, inputImage=image_file)
+            pending.append(pool.apply_async(_execute_batch_image, (execute_function, script_name, image_settings,
+                                                                   mask_file_name)))
+
+            # back-pressure: wait for the oldest image before submitting more
+            if len(pending) >= max_pending:
+                _forward_messages(feedback_queue, pending.popleft().get())
+
+        while pending:
+            _forward_messages(feedback_queue, pending.popleft().get())
+
+
+def run_folder_watch(execute_function, feedback_queue, script_name, settings, mask_file_name, folder, processes=None,
+                     max_pending=None, poll_interval=1.0, settle_time=2.0, stop_event=None):
+    """
+    Streaming mode for live camera images: watches a folder for new ENVI files (.hdr and binary data) and runs the
+    execute() function of an analysis script for each of them in a pool of worker processes. Files are only processed
+    once they are complete and haven't changed for settle_time seconds. Workers are reused, so calibration, ROI layout
+    and mask script stay loaded between frames. After the messages of a frame, its latency (time from detection of the
+    complete file to its results) and the current queue depth are signalled to the feedback queue.
+    :param execute_function: execute() of the analysis script (imported by the workers by its module name)
+    :param feedback_queue: queue of feedback messages
+    :param script_name: name of the analysis script (required for feedback queue)
+    :param settings: settings dictionary, "inputImage" is replaced with each of the new image files
+    :param mask_file_name: name of the mask script (required for feedback queue)
+    :param folder: folder the camera writes the images to
+    :param processes: number of worker processes (default: number of CPUs)
+    :param max_pending: maximum number of images submitted to the pool at the same time (default: 2 x processes)
+    :param poll_interval: time between two scans of the folder in seconds
+    :param settle_time: time in seconds the size of a file has to stay unchanged before it is processed
+    :param stop_event: threading/multiprocessing Event, the folder is watched until it is set (default: forever)
+    """
+    processes = processes or os.cpu_count() or 1
+    max_pending = max(max_pending or 2 * processes, 1)
+
+    # images already in the folder are not processed
+    seen = set(glob.glob(os.path.join(folder, "*.hdr")))
+    candidates = {}  # .hdr file: (size of the files, time the size was first seen)
+    ready = collections.deque()  # complete files, (.hdr file, time the file was complete)
+    pending = collections.deque()  # submitted files, (.hdr file, time the file was complete, async result)
+
+    with _create_batch_pool(execute_function, processes, mask_file_name) as pool:
+        while not (stop_event is not None and stop_event.is_set()):
+            now = time.time()
+
+            # debounce partially written files
+            for hdr_file in sorted(set(glob.glob(os.path.join(folder, "*.hdr"))) - seen):
+                size = _envi_file_size(hdr_file)
+                if size is None:  # header or binary data not complete yet
+                    continue
+                if hdr_file not in candidates or candidates[hdr_file][0] != size:
+                    candidates[hdr_file] = (size, now)
+                elif now - candidates[hdr_file][1] >= settle_time:
+                    del candidates[hdr_file]
+                    seen.add(hdr_file)
+                    ready.append((hdr_file, now))
+
+            # back-pressure: don't submit more than max_pending images
+            while ready and len(pending) < max_pending:
+                hdr_file, complete_time = ready.popleft()
+                image_settings = dict(settings, inputImage=hdr_file)
+                pending.append((hdr_file, complete_time, pool.apply_async(
+                    _execute_batch_image, (execute_function, script_name, image_settings, mask_file_name))))
+
+            # signal results in the order the images arrived
+            while pending and pending[0][2].ready():
+                hdr_file, complete_time, result = pending.popleft()
+                _forward_messages(feedback_queue, result.get())
+                feedback_queue.put([script_name, f"Frame {os.path.basename(hdr_file)}: latency "
+                                                 f"{time.time() - complete_time:.2f} s, queue depth "
+                                                 f"{len(pending) + len(ready)}"])
+
+            time.sleep(poll_interval)
+
+        while pending:
+            _forward_messages(feedback_queue, pending.popleft()[2].get())
+
+
+def _envi_file_size(hdr_file):
+    """
+    Helper function that checks if an ENVI file has been written completely
+    :param hdr_file: path to the .hdr file
+    :return: combined size of header and binary data, None if the binary data is missing or incomplete
+    """
+    img_file = os.path.splitext(hdr_file)[0]
+    binary_file = find_envi_binary(img_file)
+    if binary_file is None:
+        return None
+
+    try:
+        header = read_envi_header(hdr_file)
+        d_type = np.dtype(ENVI_DATA_TYPES[int(header.get("data type", 1))])
+        expected_size = int(header.get("header offset", 0)) + \
+            int(header["samples"]) * int(header["lines"]) * int(header["bands"]) * d_type.itemsize
+        size = os.path.getsize(binary_file)
+        if size < expected_size:
+            return None
+        return size + os.path.getsize(hdr_file)
+    except (OSError, KeyError, ValueError):  # header not complete yet
+        return None
+
+
+def _create_batch_pool(execute_function, processes, mask_file_name):
+    """
+    Helper function that creates the worker pool for batch and streaming execution
+    :param execute_function: execute() of the analysis script
+    :param processes: number of worker processes
+    :param mask_file_name: name of the mask script, loaded once when a worker starts
+    :return: multiprocessing pool
+    """
+    # worker processes have to be able to import the analysis script by its module name
+    script_path = os.path.dirname(os.path.abspath(execute_function.__code__.co_filename))
+    if script_path not in sys.path:
+        sys.path.append(script_path)
+
+    return multiprocessing.Pool(processes, initializer=_init_batch_worker, initargs=(mask_file_name, processes))
+
+
+def _init_batch_worker(mask_file_name, processes):
+    # the worker processes share the cores
+    global PREPROCESSING_THREADS
+    PREPROCESSING_THREADS = max(1, PREPROCESSING_THREADS // processes)
+
+    if mask_file_name != "":
+        load_mask_module(mask_file_name)
+
+
+class MessageList(list):
+    """
+    Stand-in for the feedback queue that collects the messages, e.g. inside of batch worker processes (the messages are
+    returned to the main process) or in the benchmark and the tests
+    """
+    def put(self, message):
+        self.append(message)
+
+
+def _execute_batch_image(execute_function, script_name, settings, mask_file_name):
+    """
+    Runs execute() of the analysis script for a single image inside of a batch worker process
+    :return: list of feedback messages
+    """
+    messages = MessageList()
+    try:
+        execute_function(messages, script_name, settings, mask_file_name)
+        get_image_writer().flush()  # the preview message is signalled after the image was written
+    except Exception as e:  # don't stop the batch because of a single image
+        messages.put([script_name, f"Error processing {settings['inputImage']}: {e!r}"])
+
+    return messages
+
+
+def _forward_messages(feedback_queue, messages):
+    for message in messages:
+        feedback_queue.put(message)
+
+
+def load_mask_module(mask_file_name):
+    """
+    Helper function that loads an external mask script. Each script is only imported once and then taken from the
+    cache, unless the file was changed since (modification time).
+    :param mask_file_name: path to the mask script
+    :return: mask script module (providing create_mask())
+    """
+    mask_file_name = os.path.abspath(mask_file_name)
+    if not os.path.splitext(mask_file_name)[1]:
+        mask_file_name += ".py"
+    mtime = os.path.getmtime(mask_file_name)
+
+    cached = _mask_modules.get(mask_file_name)
+    if cached is None or cached[0] != mtime:
+        mask_path, mask_file = os.path.split(mask_file_name)
+        if mask_path not in sys.path:  # allows the mask script to import modules from its folder
+            sys.path.append(mask_path)
+
+        spec = importlib.util.spec_from_file_location(os.path.splitext(mask_file)[0], mask_file_name)
+        mask_script = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mask_script)
+        _mask_modules[mask_file_name] = (mtime, mask_script)
+
+    return _mask_modules[mask_file_name][1]
@@ -3,8 +3,41 @@ import numpy as np
 import warnings
 from plantcv import plantcv as pcv
 import sys
-import importlib
-import rayn_utils
+
+# helpers shared with the mask script: rvs_helpers.py next to this script or in the folder above it (don't change this)
+_script_folder = os.path.dirname(os.path.abspath(__file__))
+for _folder in (_script_folder, os.path.dirname(_script_folder)):
+    if os.path.exists(os.path.join(_folder, "rvs_helpers.py")):
+        if _folder not in sys.path:
+            sys.path.append(_folder)
+        break
+from rvs_helpers import (  # noqa: E402
+    INDEX_FUNCTIONS, prepare_spectral_data, preview_key, preview_stage, shared_stages, downscale_preview, write_image,
+    find_envi_binary, get_logger, label_rois, roi_statistics, tiled_index_statistics, index_statistics_per_mask,
+    create_results_table, results_table_to_list, get_results_store, get_image_writer, start_image_metrics,
+    finish_image_metrics, load_mask_module, run_batch, run_folder_watch)
+
+logger = get_logger(__name__)
+
+# performance settings (edit this, if required), the settings of loading the images, writing them in the
+# background, the metrics and the results store are defined in rvs_helpers.py
+# fields of the per-ROI results signalled to the feedback queue ("roi" and "plot_value" are required)
+RESULTS_FIELDS = [("roi", np.int32),
+                  ("area", np.float64),
+                  ("width", np.float64),
+                  ("height", np.float64),
+                  ("perimeter", np.float64),
+                  ("index", "U32"),
+                  ("mean", np.float64),
+                  ("median", np.float64),
+                  ("std", np.float64),
+                  ("plot_value", np.float64)]
+SIGNAL_RESULTS = True  # signal the results of each image as 'results' message (used by the charts of the application)
+RESULTS_STORE_DIR = None  # folder of the on-disk results store of all images, e.g. "C:/rvs_results" (None = no store)
+
+# output images (compression of PNG and JPEG images: see rvs_helpers.py)
+IMAGE_FORMAT = ".png"  # file format of the processed images (e.g. ".jpg" or ".bmp" are written faster)
+THUMBNAIL_MAX_SIZE = None  # longer side (px) of the processed images (None = full size)
 
 
 # Default mask workflow. Selection of other mask scripts is possible in the UI.
@@ -24,18 +57,25 @@ def create_mask(settings, mask_preview=True):
     value_example_thresh_mask = mask_options["example_thresh_mask"]                 # edit/remove this
     value_example_checkbox_mask = mask_options["example_checkbox_mask"]             # edit/remove this
 
-    spectral_array = prepare_spectral_data(settings)
+    # in the mask preview, the prepared data and the results of each stage are kept as long as their inputs don't change
+    image_key = preview_key(settings)
+    spectral_array = preview_stage("spectral_data", image_key, prepare_spectral_data, enabled=mask_preview,
+                                   settings=settings)
 
     # BEGIN EXAMPLE MASK ACTION - replace or edit
     # get data from selected wavelength band
     if (value_wavelength_mask != "None") and (value_wavelength_mask != ""):
-        selected_layer = spectral_array.array_data[:, :, int(spectral_array.wavelength_dict[int(value_wavelength_mask)])]
+        band = int(spectral_array.wavelength_dict[int(value_wavelength_mask)])
     else:
-        selected_layer = spectral_array.array_data[:, :, 0]
+        band = 0
         warnings.warn("No wavelength for mask selected. Defaulting to first in list")
 
+    selected_layer = preview_stage("layer", (image_key, band), lambda: spectral_array.array_data[:, :, band],
+                                   enabled=mask_preview)
+
     # create binary mask from layer using an adjustable threshold
-    binary_img = pcv.threshold.binary(gray_img=selected_layer, threshold=value_example_thresh_mask)
+    binary_img = preview_stage("mask", (image_key, band, value_example_thresh_mask), pcv.threshold.binary,
+                               enabled=mask_preview, gray_img=selected_layer, threshold=value_example_thresh_mask)
 
     # END EXAMPLE MASK ACTION
 
@@ -53,7 +93,12 @@ def execute(feedback_queue, script_name, settings, mask_file_name):
     :param settings: settings dictionary
     :param mask_file_name: name of the mask script (required for feedback queue
     """
-    print("Execute:", script_name, settings)
+    logger.info("Execute: %s", script_name)
+    logger.debug("Settings: %s", settings)
+
+    # collect the time of each stage, signalled as 'metrics' message (don't change this)
+    metrics = start_image_metrics(feedback_queue, script_name)
+
     # Load parameters from the settings dict (don't change this)
     out_folder = settings["outputFolder"]  # target folder
     roi_items = settings["experimentSettings"]["roiInfo"]["roiItems"]  # ROI coordinates
@@ -73,26 +118,25 @@ def execute(feedback_queue, script_name, settings, mask_file_name):
 
     # plantCV settings
     pcv.params.debug = None
+    pcv.outputs.clear()  # make sure no results of previously processed images end up in the results of this image
 
     # determine mask script based on the chosen option (don't change this)
     if mask_file_name != "":  # external mask script (= mask function defined in another file)
-        mask_path, mask_file = os.path.split(mask_file_name)
-        print("External mask file used: ", mask_file_name)
+        logger.info("External mask file used: %s", mask_file_name)
 
-        sys.path.append(mask_path)
-        mask_script = importlib.import_module(mask_file.replace(".py", ""))
-        create_function = mask_script.create_mask
+        create_function = load_mask_module(mask_file_name).create_mask
 
     else:  # default/internal mask script is used (= mask function defined in this script)
-        print("Internal mask used")
+        logger.info("Internal mask used")
 
         create_function = create_mask
 
     # BEGIN WORKFLOW
-    print("Starting workflow")
+    logger.debug("Starting workflow")
 
     # retrieving preprocessed data cube and mask (don't change this)
-    spectral_array, mask = create_mask(settings, mask_preview=False)
+    spectral_array, mask = create_function(settings, mask_preview=False)
+    metrics.checkpoint("mask")
 
     # extract image name (don't change this)
     filename = spectral_array.filename
@@ -102,48 +146,44 @@ def execute(feedback_queue, script_name, settings, mask_file_name):
     # signal which file is processed (don't change this)
     feedback_queue.put([script_name, 'Processing: ' + spectral_array.filename])
 
-    # copy unaltered pseudo rgb image for plotting results/debug information on it later (optional)
-    img_plant_labelled = np.copy(spectral_array.pseudo_rgb)
-    img_roi_labelled = np.copy(spectral_array.pseudo_rgb)
+    # unaltered pseudo rgb image for plotting results/debug information on it later (optional), copy it before drawing
+    img_plant_labelled = spectral_array.pseudo_rgb
 
-    # process ROI items forwarded from the UI  (don't change this)
-    rois = process_rois(roi_items, img_roi_labelled)
-
-    # identify objects in the ROIs  (edit this, if required)
-    labeled_objects, n_obj = pcv.create_labels(mask=mask, rois=rois, roi_type="partial")
+    # identify objects in the ROIs forwarded from the UI  (edit this, if required)
+    # same labels as process_rois() followed by pcv.create_labels(mask=mask, rois=rois, roi_type="partial")
+    labeled_objects, n_obj = label_rois(roi_items, mask)
+    metrics.checkpoint("labels")
 
     # EXAMPLE analyzing objects
+    # shape parameters of all objects (same values as pcv.analyze.size, without the diagnostic image)
+    roi_stats = roi_statistics(labeled_objects, n_obj)
+
     if value_example_checkbox_script:  # analyze spectral index selected via a dynamic dropdown
-        index_functions = rayn_utils.get_index_functions()
-        index_array = index_functions[value_dynamic_dropdown_script][1](spectral_array, 10)
-        pcv.analyze.spectral_index(index_img=index_array,
-                                   labeled_mask=labeled_objects,
-                                   n_labels=n_obj,
-                                   label="plant")
-
-    if value_custom_dropdown_script == "shape":  # shape spectral index
+        # index statistics of all objects (replaces pcv.analyze.spectral_index), large images are processed in tiles
+        roi_stats.update(tiled_index_statistics(spectral_array, value_dynamic_dropdown_script, labeled_objects, n_obj,
+                                                10))
+
+    if value_custom_dropdown_script == "shape":  # shape analysis image (the observations are cleared below)
         img_plant_labelled = pcv.analyze.size(img=img_plant_labelled,
                                               labeled_mask=labeled_objects,
                                               n_labels=n_obj,
                                               label="plant")
+    metrics.checkpoint("analysis")
 
-    # return preview image
-    image_file_name = os.path.normpath(out_folder + "/ProcessedImages/" + image_name + ".png")
-    path, file_name = os.path.split(image_file_name)
+    # return preview image, it is written in the background while the results are processed
+    image_file_name = os.path.normpath(out_folder + "/ProcessedImages/" + image_name + IMAGE_FORMAT)
 
-    if not os.path.exists(path):
-        os.makedirs(path)
-        print("created folder " + path)
+    def signal_preview(file_name):
+        # Use feedbackQueue.put to send feedback to the main application (as soon as the image is written)
+        feedback_queue.put([script_name, 'preview', file_name])
 
-    print("Writing image to " + image_file_name)
+    logger.debug("Writing image to %s", image_file_name)
 
-    pcv.print_image(img=img_plant_labelled, filename=image_file_name)
+    get_image_writer().write(img_plant_labelled, image_file_name, max_size=THUMBNAIL_MAX_SIZE,
+                             callback=signal_preview, metrics=metrics)
+    metrics.checkpoint("write")
 
-    # Use feedbackQueue.put to send feedback to the main application
-    print("writing info to queue")
-    feedback_queue.put([script_name, 'preview', image_file_name])
-
-    print("Workflow done")
+    logger.info("Workflow done")
 
     # END WORKFLOW
 
@@ -153,137 +193,193 @@ def execute(feedback_queue, script_name, settings, mask_file_name):
     #       Adding meta data to the results will be possible in a later version of PlantCV
     #       which will in turn make the result processing done here obsolete
 
-    results = pcv.outputs.observations  # get the results
-
     results_dict = {}  # prepare empty dict to store filtered results in.
-    results_list = []
-
-    index_key = "index_" + value_dynamic_dropdown_script
 
     if plot_selection == "plot_index":
-        selected_key = "mean_" + index_key
+        selected_column = "mean"
     else:
-        selected_key = plot_selection
-
-    for i in range(1, n_obj + 1):  # loop through analyzed objects (plants)
-        if f"plant_{i}" in results:
-            roi_results = results[f"plant_{i}"]
-
-            # this part has to be adjusted to the analyses that are performed.
-            # below you can find example results from analyze.spectral_index and analyze.size called in the workflow
-            # we recommend to look at the full results output (e.g. with print(results)) and select the respective
-            # parameters you are interested in from there.
-
-            results_list.append({"roi": i,                                              # required parameter
-                                "area": roi_results["area"]["value"],
-                                "width": roi_results["width"]["value"],
-                                "height": roi_results["height"]["value"],
-                                "perimeter": roi_results["perimeter"]["value"],
-                                "index": value_dynamic_dropdown_script,
-                                "mean": roi_results["mean_" + index_key]["value"],
-                                "median": roi_results["med_" + index_key]["value"],
-                                "std": roi_results["std_" + index_key]["value"],
-                                "plot_value": roi_results[selected_key]["value"]})      # required parameter
-
-            # If you want to skip this step and do it your way, you can do the following:
-            """
-            results_list.append({"roi": i,
-                                "area": None,
-                                "width": None,
-                                "height": None,
-                                "perimeter": None,
-                                "index": None,
-                                "mean": None,
-                                "median": None,
-                                "std": None,
-                                "plot_value": None})
-            
-            
-            """
-
-    results_dict["rois"] = results_list
+        selected_column = plot_selection
+
+    # one row per ROI (= label in the labeled mask), the columns are defined in RESULTS_FIELDS
+    results_table = create_results_table(n_obj, RESULTS_FIELDS, {"index": value_dynamic_dropdown_script})
+
+    # this part has to be adjusted to the analyses that are performed.
+    # below, the columns are filled with the statistics computed by roi_statistics() in the workflow.
+    # If you use PlantCV analysis functions instead, you can copy their results into the table with
+    # fill_results_table(results_table, pcv.outputs.observations, {"area": "area", ...}) of rvs_helpers.py
+    for column in ("area", "width", "height", "perimeter", "mean", "median", "std"):
+        results_table[column] = roi_stats[column]
+    results_table["plot_value"] = roi_stats[selected_column]    # required parameter
+
+    # Values that are not filled are returned as None.
+
+    results_dict["rois"] = results_table_to_list(results_table)
+
+    # don't keep the observations of this image around until the next one is processed
+    pcv.outputs.clear()
+    metrics.checkpoint("results")
+
+    # append the results to the results store (RESULTS_STORE_DIR), the image time is the time the image was written
+    # (modification time of the binary data, filename has no extension, or of the header)
+    results_store = get_results_store(RESULTS_STORE_DIR, RESULTS_FIELDS)
+    if results_store is not None:
+        image_file = find_envi_binary(filename) or filename + ".hdr"
+        image_time = os.path.getmtime(image_file) if os.path.exists(image_file) else None
+        results_store.append(results_table, image_name, image_time)
+        metrics.checkpoint("store")
 
     # signal results
-    signal_dict = {"imageFileName": image_file_name, "dict": results_dict}
-    feedback_queue.put([script_name, 'results', signal_dict])
+    if SIGNAL_RESULTS:
+        signal_dict = {"imageFileName": image_file_name, "dict": results_dict}
+        feedback_queue.put([script_name, 'results', signal_dict])
+    metrics.checkpoint("emit")
 
+    # signal metrics (as soon as the image is written as well)
+    finish_image_metrics(metrics, image_file_name)
 
-def process_rois(roi_items, rgb_image):  # get the rois from individual coordinates
-    # creating empty ROI object
-    rois = pcv.Objects(contours=[], hierarchy=[])
 
-    for roi_type, roi_x, roi_y, roi_width, roi_height in roi_items:
-        print("RoiItem:", roi_type, roi_x, roi_y, roi_width, roi_height)
+# Parameter sweep of the analysis workflow
+def execute_sweep(feedback_queue, script_name, settings, mask_file_name, mask_option_sets, index_names=None):
+    """
+    Analyzes an image with several mask options and spectral indices in one pass, e.g. to choose a threshold. The
+    image is only read and prepared once (shared stages of create_mask(), see shared_stages()), the ROIs are
+    rasterized once and each index is computed once for all masks. The results of all variants are signalled as
+    'sweep_results' message: [script_name, 'sweep_results', {"imageFileName": ..., "variants": [{"maskOptions": ...,
+    "index": ..., "rois": [...]}, ...]}]
+    :param feedback_queue: queue of feedback messages
+    :param script_name: name of the analysis script (required for feedback queue)
+    :param settings: settings dictionary
+    :param mask_file_name: name of the mask script (required for feedback queue)
+    :param mask_option_sets: list of mask options (dictionaries), each updates the maskOptions of the settings
+    :param index_names: list of the analyzed indices (keys in INDEX_FUNCTIONS, default: index of the script options)
+    """
+    logger.info("Execute sweep: %s", script_name)
 
-        if roi_type == "Circle":
-            roi_radius = int(roi_width / 2)
-            # create a single circular roi
-            roi = pcv.roi.circle(x=roi_x, y=roi_y, r=roi_radius, img=rgb_image)
-        elif roi_type == "Rectangle":
-            # create a single rectangle roi
-            print("calculated x/y", roi_x - roi_width / 2, roi_y - roi_height / 2)
-            roi = pcv.roi.rectangle(x=roi_x - roi_width / 2, y=roi_y - roi_height / 2,
-                                    h=roi_height, w=roi_width, img=rgb_image)
+    # collect the time of each stage, signalled as 'metrics' message (don't change this)
+    metrics = start_image_metrics(feedback_queue, script_name)
 
-        else:
-            warnings.warn("Roi type is neither circle or rectangle")
-            break
+    # Load parameters from the settings dict (don't change this)
+    roi_items = settings["experimentSettings"]["roiInfo"]["roiItems"]  # ROI coordinates
+    script_options = settings["experimentSettings"]["scriptOptions"]["general"]
+    plot_selection = settings["experimentSettings"]["analysis"]["chartOptions"]["plot_selection"]
+    if index_names is None:
+        index_names = [script_options["dynamic_dropdown_script"]]
+    if not mask_option_sets:
+        mask_option_sets = [{}]  # mask options of the settings
 
-        # append the roi contour and hierarchy to the object collecting all the rois
-        rois.append(roi.contours, roi.hierarchy)
+    pcv.params.debug = None
 
-    return rois
+    # determine mask script based on the chosen option (don't change this)
+    if mask_file_name != "":  # external mask script (= mask function defined in another file)
+        create_function = load_mask_module(mask_file_name).create_mask
+    else:  # default/internal mask script is used (= mask function defined in this script)
+        create_function = create_mask
 
+    # one mask per set of mask options, all of them use the same prepared image data
+    # (mask scripts share the stages if they use preview_stage() of rvs_helpers.py, like the template mask script)
+    labeled_masks = []
+    with shared_stages():
+        for mask_options in mask_option_sets:
+            variant_settings = sweep_settings(settings, mask_options)
+            spectral_array, mask = create_function(variant_settings, mask_preview=False)
+            labeled_masks.append(label_rois(roi_items, mask))  # the filled ROIs are cached and shared
+    metrics.checkpoint("mask")
 
-def prepare_spectral_data(settings):
-    # file and folder
-    img_file = settings["inputImage"]
-    # undistort and normalize
-    image_options = settings["experimentSettings"]["imageOptions"]
+    filename = spectral_array.filename
+    feedback_queue.put([script_name, 'Processing: ' + filename])
 
-    lens_angle = image_options["lensAngle"]
-    dark_normalize = image_options["normalize"]
+    # shape parameters per mask, index statistics per index and mask (each index is only computed once)
+    shape_stats = [roi_statistics(labeled_objects, n_obj) for labeled_objects, n_obj in labeled_masks]
+    index_stats = {name: index_statistics_per_mask(spectral_array, name, labeled_masks, 10) for name in index_names}
+    metrics.checkpoint("analysis")
 
-    # check if a .hdr file name was provided and set img_file to the binary location
-    if os.path.splitext(img_file)[1] == ".hdr":
-        img_file = os.path.splitext(img_file)[0]
+    selected_column = "mean" if plot_selection == "plot_index" else plot_selection
 
-    else:
-        warnings.warn("No header file provided. Processing not possible.")
-        return
+    variants = []
+    for mask_number, mask_options in enumerate(mask_option_sets):
+        for name in index_names:
+            results_table = create_results_table(labeled_masks[mask_number][1], RESULTS_FIELDS, {"index": name})
+            roi_stats = dict(shape_stats[mask_number], **index_stats[name][mask_number])
+            for column in ("area", "width", "height", "perimeter", "mean", "median", "std"):
+                results_table[column] = roi_stats[column]
+            results_table["plot_value"] = roi_stats[selected_column]
 
-    # begin masking workflow
-    spectral_data = pcv.readimage(filename=img_file, mode='envi')
-    spectral_data.array_data = spectral_data.array_data.astype("float32")  # required for further calculations
-    if spectral_data.d_type == np.uint8:  # only convert if data seems to be uint8
-        spectral_data.array_data = spectral_data.array_data / 255  # convert 0-255 (orig.) to 0-1 range
+            variants.append({"maskOptions": dict(mask_options), "index": name,
+                             "rois": results_table_to_list(results_table)})
+    metrics.checkpoint("results")
 
-    # normalize the image cube
-    if dark_normalize:
-        spectral_data.array_data = rayn_utils.dark_normalize_array_data(spectral_data)
+    # signal results of all variants
+    feedback_queue.put([script_name, 'sweep_results', {"imageFileName": filename, "variants": variants}])
+    metrics.checkpoint("emit")
 
-    # undistort the image cube
-    if lens_angle != 0:  # only undistort if angle is selected
-        cam_calibration_file = f"calibration_data/{lens_angle}_calibration_data.yml"  # select the data set
-        mtx, dist = rayn_utils.load_coefficients(cam_calibration_file)  # depending on the lens angle
-        spectral_data.array_data = rayn_utils.undistort_data_cube(spectral_data.array_data, mtx, dist)
-        spectral_data.pseudo_rgb = rayn_utils.undistort_data_cube(spectral_data.pseudo_rgb, mtx, dist)
+    # signal metrics (no processed image is written)
+    finish_image_metrics(metrics, filename)
+    metrics.done("image")
 
-    return spectral_data
+
+def sweep_settings(settings, mask_options):
+    """
+    Helper function that returns a copy of the settings with other mask options (the settings aren't changed)
+    :param settings: settings dictionary
+    :param mask_options: dictionary of mask options replacing those of the settings
+    :return: settings dictionary
+    """
+    experiment_settings = dict(settings["experimentSettings"])
+    analysis = dict(experiment_settings["analysis"])
+    analysis["maskOptions"] = dict(analysis["maskOptions"], **mask_options)
+    experiment_settings["analysis"] = analysis
+
+    return dict(settings, experimentSettings=experiment_settings)
+
+
+# Batch execution of the analysis workflow
+def execute_batch(feedback_queue, script_name, settings, mask_file_name, image_files, processes=None,
+                  max_pending=None):
+    """
+    Runs execute() for a list of images in a pool of worker processes (see run_batch() of rvs_helpers.py)
+    :param feedback_queue: queue of feedback messages
+    :param script_name: name of the analysis script (required for feedback queue)
+    :param settings: settings dictionary, "inputImage" is replaced with each of the image files
+    :param mask_file_name: name of the mask script (required for feedback queue)
+    :param image_files: list of .hdr files or glob pattern (e.g. "C:/images/*.hdr")
+    :param processes: number of worker processes (default: number of CPUs)
+    :param max_pending: maximum number of images submitted to the pool at the same time (default: 2 x processes)
+    """
+    run_batch(execute, feedback_queue, script_name, settings, mask_file_name, image_files, processes, max_pending)
+
+
+def watch_folder(feedback_queue, script_name, settings, mask_file_name, folder, processes=None, max_pending=None,
+                 poll_interval=1.0, settle_time=2.0, stop_event=None):
+    """
+    Streaming mode for live camera images: runs execute() for each new ENVI file written to a folder (see
+    run_folder_watch() of rvs_helpers.py)
+    :param feedback_queue: queue of feedback messages
+    :param script_name: name of the analysis script (required for feedback queue)
+    :param settings: settings dictionary, "inputImage" is replaced with each of the new image files
+    :param mask_file_name: name of the mask script (required for feedback queue)
+    :param folder: folder the camera writes the images to
+    :param processes: number of worker processes (default: number of CPUs)
+    :param max_pending: maximum number of images submitted to the pool at the same time (default: 2 x processes)
+    :param poll_interval: time between two scans of the folder in seconds
+    :param settle_time: time in seconds the size of a file has to stay unchanged before it is processed
+    :param stop_event: threading/multiprocessing Event, the folder is watched until it is set (default: forever)
+    """
+    run_folder_watch(execute, feedback_queue, script_name, settings, mask_file_name, folder, processes, max_pending,
+                     poll_interval, settle_time, stop_event)
 
 
 def create_mask_preview(mask, settings, create_preview=True):
     if create_preview:
         out_image = settings["outputImage"]
         image_file_name = os.path.normpath(out_image)
-        print("Writing image to " + image_file_name)
-        pcv.print_image(img=mask, filename=image_file_name)
+        logger.debug("Writing image to %s", image_file_name)
+        write_image(downscale_preview(mask), image_file_name)
 
 
 def dropdown_values(setting, wavelengths):  # fills the index dropdown (see .config file)
 
     if setting == "index_list":  # defines the UI element this is applied to
-        index_dict_dd = rayn_utils.get_index_functions()
+        index_dict_dd = INDEX_FUNCTIONS
         name_list = list(index_dict_dd)
         display_name_list = [item[0] for item in index_dict_dd.values()]
 
@@ -294,7 +390,7 @@ def dropdown_values(setting, wavelengths):  # fills the index dropdown (see .con
 
 
 def range_values(setting, name, index):  # sets the slider ranges (see .config file)
-    print("range_values", setting, name, index)
+    logger.debug("range_values %s %s %s", setting, name, index)
 
     # set default values
     value = 0.5
@@ -303,12 +399,12 @@ def range_values(setting, name, index):  # sets the slider ranges (see .config f
     steps = 10
 
     if setting == "mask_index":  # defines the UI element this is applied to
-        index_functions = rayn_utils.get_index_functions()
+        index_functions = INDEX_FUNCTIONS
         minimum = index_functions[name][2]
         maximum = index_functions[name][3]
         value = (maximum - minimum) / 2 + minimum
         steps = 500
-        print(f"index settings: min {minimum}, max {maximum}, steps {steps}, value {value}")
+        logger.debug("index settings: min %s, max %s, steps %s, value %s", minimum, maximum, steps, value)
 
     return minimum, maximum, steps, value
 
@@ -319,16 +415,8 @@ def get_display_name_for_chart(settings):
     script_options = settings["experimentSettings"]["scriptOptions"]["general"]
     value_dynamic_dropdown_script = script_options["dynamic_dropdown_script"]
 
-    index_key = "index_" + value_dynamic_dropdown_script
-
-    if plot_selection == "plot_index":
-        selected_key = "mean_" + index_key
-    else:
-        selected_key = plot_selection
-
     if plot_selection == "plot_index":
-        index_dict_dd = rayn_utils.get_index_functions()
-        full_index_name = index_dict_dd[selected_key][0]
+        full_index_name = INDEX_FUNCTIONS[value_dynamic_dropdown_script][0]
         title = full_index_name
         y_label = "relative index value"
 
@@ -1,8 +1,20 @@
 import os
-import numpy as np
+import sys
 import warnings
 from plantcv import plantcv as pcv
-import rayn_utils
+
+# helpers shared with the analysis scripts: rvs_helpers.py next to this script or in the folder above it (don't change
+# this). The settings of loading the images (e.g. LAZY_LOADING) are defined in rvs_helpers.py.
+_script_folder = os.path.dirname(os.path.abspath(__file__))
+for _folder in (_script_folder, os.path.dirname(_script_folder)):
+    if os.path.exists(os.path.join(_folder, "rvs_helpers.py")):
+        if _folder not in sys.path:
+            sys.path.append(_folder)
+        break
+from rvs_helpers import (INDEX_FUNCTIONS, prepare_spectral_data, preview_key, preview_stage,  # noqa: E402
+                         downscale_preview, write_image, get_logger)
+
+logger = get_logger(__name__)
 
 
 def create_mask(settings, mask_preview=True):
@@ -21,18 +33,25 @@ def create_mask(settings, mask_preview=True):
     value_example_thresh_mask = mask_options["example_thresh_mask"]                 # edit/remove this
     value_example_checkbox_mask = mask_options["example_checkbox_mask"]             # edit/remove this
 
-    spectral_array = prepare_spectral_data(settings)
+    # in the mask preview, the prepared data and the results of each stage are kept as long as their inputs don't change
+    image_key = preview_key(settings)
+    spectral_array = preview_stage("spectral_data", image_key, prepare_spectral_data, enabled=mask_preview,
+                                   settings=settings)
 
     # BEGIN EXAMPLE MASK ACTION - replace or edit
     # get data from selected wavelength band
     if (value_wavelength_mask != "None") and (value_wavelength_mask != ""):
-        selected_layer = spectral_array.array_data[:, :, int(spectral_array.wavelength_dict[int(value_wavelength_mask)])]
+        band = int(spectral_array.wavelength_dict[int(value_wavelength_mask)])
     else:
-        selected_layer = spectral_array.array_data[:, :, 0]
+        band = 0
         warnings.warn("No wavelength for mask selected. Defaulting to first in list")
 
+    selected_layer = preview_stage("layer", (image_key, band), lambda: spectral_array.array_data[:, :, band],
+                                   enabled=mask_preview)
+
     # create binary mask from layer using an adjustable threshold
-    binary_img = pcv.threshold.binary(gray_img=selected_layer, threshold=value_example_thresh_mask)
+    binary_img = preview_stage("mask", (image_key, band, value_example_thresh_mask), pcv.threshold.binary,
+                               enabled=mask_preview, gray_img=selected_layer, threshold=value_example_thresh_mask)
 
     # END EXAMPLE MASK ACTION
 
@@ -53,50 +72,8 @@ def create_mask_preview(mask, settings, create_preview=True):
     if create_preview:
         out_image = settings["outputImage"]
         image_file_name = os.path.normpath(out_image)
-        print("Writing image to " + image_file_name)
-        pcv.print_image(img=mask, filename=image_file_name)
-
-
-def prepare_spectral_data(settings):
-    """
-    Helper function that loads and prepares the data of the hyper- or multispectral image
-    :param settings: settings dictionary
-    :return: spectral data (PlantCV object)
-    """
-    # file and folder
-    img_file = settings["inputImage"]
-    # undistort and normalize
-    image_options = settings["experimentSettings"]["imageOptions"]
-
-    lens_angle = image_options["lensAngle"]
-    dark_normalize = image_options["normalize"]
-
-    # check if a .hdr file name was provided and set img_file to the binary location
-    if os.path.splitext(img_file)[1] == ".hdr":
-        img_file = os.path.splitext(img_file)[0]
-
-    else:
-        warnings.warn("No header file provided. Processing not possible.")
-        return
-
-    # begin masking workflow
-    spectral_data = pcv.readimage(filename=img_file, mode='envi')
-    spectral_data.array_data = spectral_data.array_data.astype("float32")  # required for further calculations
-    if spectral_data.d_type == np.uint8:  # only convert if data seems to be uint8
-        spectral_data.array_data = spectral_data.array_data / 255  # convert 0-255 (orig.) to 0-1 range
-
-    # normalize the image cube
-    if dark_normalize:
-        spectral_data.array_data = rayn_utils.dark_normalize_array_data(spectral_data)
-
-    # undistort the image cube
-    if lens_angle != 0:  # only undistort if angle is selected
-        cam_calibration_file = f"calibration_data/{lens_angle}_calibration_data.yml"  # select the data set
-        mtx, dist = rayn_utils.load_coefficients(cam_calibration_file)  # depending on the lens angle
-        spectral_data.array_data = rayn_utils.undistort_data_cube(spectral_data.array_data, mtx, dist)
-        spectral_data.pseudo_rgb = rayn_utils.undistort_data_cube(spectral_data.pseudo_rgb, mtx, dist)
-
-    return spectral_data
+        logger.debug("Writing image to %s", image_file_name)
+        write_image(downscale_preview(mask), image_file_name)
 
 
 def dropdown_values(setting, wavelengths):
@@ -109,7 +86,7 @@ def dropdown_values(setting, wavelengths):
 
     if setting == "value_dynamic_dropdown_mask":  # defines the UI element this is applied to
         # Example: List all available indices in a dropdown
-        index_dict_dd = rayn_utils.get_index_functions()
+        index_dict_dd = INDEX_FUNCTIONS
         name_list = list(index_dict_dd)
         display_name_list = [item[0] for item in index_dict_dd.values()]
 
@@ -129,7 +106,7 @@ def range_values(setting, name, index):
     :param index:
     :return:
     """
-    print("range_values", setting, name, index)
+    logger.debug("range_values %s %s %s", setting, name, index)
 
     # set default values
     value = 0.5
@@ -139,11 +116,11 @@ def range_values(setting, name, index):
 
     if setting == "mask_index":  # defines the UI element this is applied to
         # Example: Loading the min/max slider limits for each available index
-        index_functions = rayn_utils.get_index_functions()
+        index_functions = INDEX_FUNCTIONS
         minimum = index_functions[name][2]
         maximum = index_functions[name][3]
         value = (maximum - minimum) / 2 + minimum
         steps = 500
-        print(f"index settings: min {minimum}, max {maximum}, steps {steps}, value {value}")
+        logger.debug("index settings: min %s, max %s, steps %s, value %s", minimum, maximum, steps, value)
 
-    return minimum, maximum, steps, value
\ No newline at end of file
+    return minimum, maximum, steps, value
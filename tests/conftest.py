@@ -0,0 +1,57 @@
+"""
+Shared fixtures of the tests. The tests require the same Python environment as the scripts (PlantCV, rayn_utils,
+OpenCV), they are skipped if rayn_utils is not available. Run them from the repository folder: python -m pytest tests
+"""
+import os
+import sys
+import importlib.util
+import numpy as np
+import pytest
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ANALYSIS_SCRIPT = os.path.join(REPOSITORY_FOLDER, "template_analysis_script", "template_analysis_script.py")
+MASK_SCRIPT = os.path.join(REPOSITORY_FOLDER, "template_mask_script", "template_mask_script.py")
+
+if REPOSITORY_FOLDER not in sys.path:
+    sys.path.insert(0, REPOSITORY_FOLDER)
+
+
+def load_script(path):
+    """
+    Loads a script the same way RVS Analytics does (module named after the file)
+    :param path: path of the script
+    :return: module
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+
+    return sys.modules[name]
+
+
+def write_envi_image(img_file, cube, extension=".raw", interleave="bsq", wavelengths=(500, 600, 700, 800)):
+    """
+    Writes an ENVI image (header img_file + ".hdr", binary data img_file + extension) of a lines x samples x bands cube
+    (uint8, int16, uint16 or float32)
+    """
+    lines, samples, bands = cube.shape
+    data_type = {"uint8": 1, "int16": 2, "float32": 4, "uint16": 12}[cube.dtype.name]
+    with open(img_file + ".hdr", "w") as header_file:
+        header_file.write(f"ENVI\nsamples = {samples}\nlines = {lines}\nbands = {bands}\nheader offset = 0\n"
+                          f"data type = {data_type}\ninterleave = {interleave}\nbyte order = 0\n"
+                          f"wavelength = {{{', '.join(str(wavelength) for wavelength in wavelengths)}}}\n")
+    axes = {"bsq": (2, 0, 1), "bil": (0, 2, 1), "bip": (0, 1, 2)}[interleave]
+    np.ascontiguousarray(cube.astype(cube.dtype.newbyteorder("<")).transpose(axes)).tofile(img_file + extension)
+
+
+@pytest.fixture
+def analysis_script():
+    return load_script(ANALYSIS_SCRIPT)
+
+
+@pytest.fixture
+def mask_script():
+    return load_script(MASK_SCRIPT)
@@ -0,0 +1,427 @@
+import os
+import types
+import cv2
+import numpy as np
+import pytest
+
+rayn_utils = pytest.importorskip("rayn_utils")  # provided by RVS Analytics
+rvs_helpers = pytest.importorskip("rvs_helpers")
+pcv = pytest.importorskip("plantcv.plantcv")
+
+from conftest import write_envi_image  # noqa: E402
+
+WAVELENGTHS = tuple(range(400, 1000, 60))
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "30_calibration_data.yml")
+
+
+def random_cube(dtype, shape=(37, 53, len(WAVELENGTHS)), seed=0):
+    """
+    Random lines x samples x bands cube covering the range of the data type (0-1 for float32)
+    """
+    rng = np.random.default_rng(seed)
+    if dtype == "float32":
+        return rng.random(shape, dtype=np.float32)
+    return rng.integers(0, {"uint8": 256, "int16": 4096, "uint16": 4096}[dtype], shape).astype(dtype)
+
+
+def readimage(img_file):
+    """
+    Spectral data as prepared by the template scripts before the lazy loading: pcv.readimage, conversion to float32 and
+    to the 0-1 range for uint8 data
+    """
+    spectral_data = pcv.readimage(filename=img_file, mode="envi")
+    spectral_data.array_data = spectral_data.array_data.astype("float32")
+    if spectral_data.d_type == np.uint8:
+        spectral_data.array_data = spectral_data.array_data / 255
+
+    return spectral_data
+
+
+def test_compute_undistort_maps_matches_rayn_utils():
+    # synthetic calibration, strong barrel distortion so the border of the image is mapped outside of it
+    width, height = 131, 97
+    mtx = np.array([[120., 0, width / 2], [0, 120., height / 2], [0, 0, 1]])
+    dist = np.array([[-0.3, 0.1, 0, 0, 0]])
+    undistort_maps = rvs_helpers.compute_undistort_maps(mtx, dist, width, height)
+
+    cube = np.random.default_rng(1).random((height, width, 7), dtype=np.float32)
+    expected = np.asarray(rayn_utils.undistort_data_cube(cube.copy(), mtx, dist))
+    np.testing.assert_allclose(rvs_helpers.undistort_bands(cube, undistort_maps), expected, rtol=0, atol=1e-6)
+
+    # pseudo rgb image (uint8)
+    rgb = (cube[:, :, :3] * 255).astype(np.uint8)
+    expected = np.asarray(rayn_utils.undistort_data_cube(rgb.copy(), mtx, dist))
+    np.testing.assert_array_equal(rvs_helpers.undistort_bands(rgb, undistort_maps), expected)
+
+    assert rvs_helpers.undistort_maps_match(undistort_maps, mtx, dist)
+
+
+def test_calibration_data_matches_rayn_utils():
+    # camera calibration of a wide-angle lens at full sensor size (OpenCV FileStorage file)
+    calibration = cv2.FileStorage(CALIBRATION_FILE, cv2.FILE_STORAGE_READ)
+    mtx, dist = calibration.getNode("K").mat(), calibration.getNode("D").mat()
+    calibration.release()
+    for width, height in ((640, 480), (1280, 1024)):
+        assert rvs_helpers.undistort_maps_match(rvs_helpers.compute_undistort_maps(mtx, dist, width, height), mtx, dist)
+
+
+def test_get_undistort_maps_falls_back_to_rayn_utils(monkeypatch):
+    mtx = np.array([[120., 0, 32], [0, 120., 24], [0, 0, 1]])
+    dist = np.array([[-0.3, 0.1, 0, 0, 0]])
+    monkeypatch.setattr(rayn_utils, "load_coefficients", lambda cam_calibration_file: (mtx, dist))
+    monkeypatch.setattr(rvs_helpers, "_undistort_maps", {})
+    assert rvs_helpers.get_undistort_maps(-1, 64, 48) is not None
+
+    # a different undistortion (here: none) is detected
+    monkeypatch.setattr(rvs_helpers, "_undistort_maps", {})
+    monkeypatch.setattr(rayn_utils, "undistort_data_cube", lambda cube, mtx, dist: cube)
+    with pytest.warns(UserWarning, match="differs from rayn_utils"):
+        assert rvs_helpers.get_undistort_maps(-1, 64, 48) is None
+
+
+def test_get_logger_prints_to_stdout(monkeypatch, capsys):
+    logger = rvs_helpers.get_logger("test_get_logger_prints_to_stdout")
+    logger.info("Writing image to %s", "image.png")
+    logger.debug("not shown")
+    assert capsys.readouterr().out == "Writing image to image.png\n"
+
+    # logging is configured by the host application
+    monkeypatch.setattr(rvs_helpers, "LOG_LEVEL", None)
+    assert not rvs_helpers.get_logger("test_get_logger_host_configured").handlers
+
+
+@pytest.mark.parametrize("interleave", ["bsq", "bil", "bip"])
+@pytest.mark.parametrize("dtype", ["uint8", "int16", "uint16", "float32"])
+def test_lazy_spectral_data_matches_readimage(tmp_path, dtype, interleave):
+    img_file = str(tmp_path / "image")
+    # PlantCV reads binaries without extension
+    write_envi_image(img_file, random_cube(dtype), "", interleave, WAVELENGTHS)
+    expected = readimage(img_file)
+    spectral_data = rvs_helpers.open_envi_image(img_file)
+
+    assert spectral_data.wavelength_dict == expected.wavelength_dict
+    np.testing.assert_array_equal(spectral_data.pseudo_rgb, expected.pseudo_rgb)
+    np.testing.assert_array_equal(spectral_data.array_data[:, :, 4], expected.array_data[:, :, 4])
+    np.testing.assert_array_equal(spectral_data.array_data[10:20, ..., 1:3], expected.array_data[10:20, ..., 1:3])
+    np.testing.assert_array_equal(np.asarray(spectral_data.array_data), expected.array_data)
+
+    # advanced indexing, arithmetic and ndarray methods are applied to the whole cube
+    mask = (expected.array_data[:, :, 0] > np.median(expected.array_data[:, :, 0])).astype(np.uint8) * 255
+    cube = rvs_helpers.open_envi_image(img_file).array_data
+    np.testing.assert_array_equal(cube[mask > 0], expected.array_data[mask > 0])
+    np.testing.assert_array_equal(cube[np.where(mask > 0)], expected.array_data[np.where(mask > 0)])
+    np.testing.assert_array_equal(cube[:, [1, 3], 2], expected.array_data[:, [1, 3], 2])
+    np.testing.assert_array_equal(cube * 2, expected.array_data * 2)
+    assert cube.max() == expected.array_data.max()
+
+
+def test_lazy_spectral_data_spectral_reflectance(tmp_path):
+    img_file = str(tmp_path / "image")
+    write_envi_image(img_file, random_cube("uint8"), "", "bil", WAVELENGTHS)
+    labeled_mask = np.zeros((37, 53), dtype=np.int32)
+    labeled_mask[5:15, 5:25] = 1
+    labeled_mask[20:30, 30:50] = 2
+
+    observations = []
+    for spectral_data in (readimage(img_file), rvs_helpers.open_envi_image(img_file)):
+        pcv.outputs.clear()
+        pcv.analyze.spectral_reflectance(hsi=spectral_data, labeled_mask=labeled_mask, n_labels=2, label="plant")
+        observations.append(pcv.outputs.observations)
+    pcv.outputs.clear()
+
+    assert sorted(observations[0]) == ["plant_1", "plant_2"]
+    assert observations[1] == observations[0]
+
+
+@pytest.mark.parametrize("interleave", ["bsq", "bil", "bip"])
+@pytest.mark.parametrize("dtype", ["uint8", "int16", "uint16", "float32"])
+def test_load_data_cube_matches_readimage(tmp_path, monkeypatch, dtype, interleave):
+    img_file = str(tmp_path / "image")
+    write_envi_image(img_file, random_cube(dtype), "", interleave, WAVELENGTHS)
+    expected = readimage(img_file).array_data
+
+    cube = rvs_helpers.load_data_cube(rvs_helpers.open_envi_image(img_file))
+    assert cube.dtype == expected.dtype
+    np.testing.assert_array_equal(cube, expected)
+
+    # the whole cube is loaded at once without LAZY_LOADING
+    monkeypatch.setattr(rvs_helpers, "LAZY_LOADING", False)
+    settings = {"inputImage": img_file + ".hdr", "experimentSettings": {"imageOptions": {"lensAngle": 0,
+                                                                                          "normalize": False}}}
+    spectral_data = rvs_helpers.prepare_spectral_data(settings)
+    assert isinstance(spectral_data.array_data, np.ndarray)
+    np.testing.assert_array_equal(spectral_data.array_data, expected)
+
+
+@pytest.mark.parametrize("undistort", [False, True])
+def test_preprocessing_threads_give_identical_cubes(tmp_path, monkeypatch, undistort):
+    img_file = str(tmp_path / "image")
+    write_envi_image(img_file, random_cube("uint16"), "", "bil", WAVELENGTHS)
+    mtx, dist = np.array([[60., 0, 26], [0, 60., 18], [0, 0, 1]]), np.array([[-0.3, 0.1, 0, 0, 0]])
+    expected = readimage(img_file).array_data
+    if undistort:
+        expected = rayn_utils.undistort_data_cube(expected, mtx, dist)
+
+    def open_image():
+        spectral_data = rvs_helpers.open_envi_image(img_file)
+        if undistort:
+            spectral_data.undistort_maps = rvs_helpers.compute_undistort_maps(mtx, dist, 53, 37)
+        return spectral_data
+
+    cubes = {}
+    for threads in (1, 4):
+        monkeypatch.setattr(rvs_helpers, "PREPROCESSING_THREADS", threads)
+        monkeypatch.setattr(rvs_helpers, "_preprocessing_executors", {})
+        # several chunks of bands, each processed by another thread
+        out = np.empty((37, 53, len(WAVELENGTHS)), dtype=np.float32)
+        cubes[threads] = (rvs_helpers.load_data_cube(open_image(), chunk_size=3, out=out),
+                          np.asarray(open_image().array_data))
+        assert bool(rvs_helpers._preprocessing_executors) == (threads > 1)
+        for executor in rvs_helpers._preprocessing_executors.values():
+            executor.shutdown()
+
+    for cube in cubes[1] + cubes[4]:
+        np.testing.assert_allclose(cube, expected, rtol=0, atol=1e-6 if undistort else 0)
+    np.testing.assert_array_equal(cubes[4][0], cubes[1][0])
+    np.testing.assert_array_equal(cubes[4][1], cubes[1][1])
+
+
+def create_mask(image_key, img):
+    # cached threshold stage of a mask script, THRESHOLD_TYPE is defined by preview_script()
+    return rvs_helpers.preview_stage("mask", (image_key, 100), cv2.threshold, src=img, thresh=100, maxval=255,
+                                     type=THRESHOLD_TYPE)[1]  # noqa: F821
+
+
+def preview_script(name, threshold_type):
+    """
+    create_mask() of a mask script (module) with the given name and threshold type
+    """
+    return types.FunctionType(create_mask.__code__, dict(globals(), __name__=name, THRESHOLD_TYPE=threshold_type))
+
+
+def test_preview_stage_is_cached_per_script(tmp_path):
+    img_file = str(tmp_path / "image")
+    write_envi_image(img_file, random_cube("uint8"), wavelengths=WAVELENGTHS)
+    settings = {"inputImage": img_file + ".hdr", "experimentSettings": {"imageOptions": {"lensAngle": 0,
+                                                                                          "normalize": False}}}
+    img = np.arange(256, dtype=np.uint8).reshape(16, 16)
+    light = preview_script("light_mask_script", cv2.THRESH_BINARY)
+    dark = preview_script("dark_mask_script", cv2.THRESH_BINARY_INV)
+
+    image_key = rvs_helpers.preview_key(settings)
+    light_mask = light(image_key, img)
+    dark_mask = dark(image_key, img)
+    np.testing.assert_array_equal(dark_mask, 255 - light_mask)
+    assert light(image_key, img) is light_mask  # cached
+    assert len(rvs_helpers._preview_cache) == 2
+
+    # another image releases the cached stages
+    settings["experimentSettings"]["imageOptions"]["normalize"] = True
+    assert rvs_helpers.preview_key(settings) != image_key
+    assert not rvs_helpers._preview_cache
+
+    # so does the analysis of an image
+    light(image_key, img)
+    rvs_helpers.preview_stage("mask", None, lambda: None, enabled=False)
+    assert not rvs_helpers._preview_cache
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "uint16", "float32"])
+def test_cube_cache_hit_matches_readimage(tmp_path, monkeypatch, dtype):
+    img_file = str(tmp_path / "image")
+    write_envi_image(img_file, random_cube(dtype), "", "bil", WAVELENGTHS)
+    settings = {"inputImage": img_file + ".hdr", "experimentSettings": {"imageOptions": {"lensAngle": 0,
+                                                                                          "normalize": False}}}
+    expected = readimage(img_file).array_data
+    monkeypatch.setattr(rvs_helpers, "CUBE_CACHE_DIR", str(tmp_path / "cache"))
+    loaded = []
+    load_data_cube = rvs_helpers.load_data_cube
+    monkeypatch.setattr(rvs_helpers, "load_data_cube", lambda *args, **kwargs: loaded.append(args) or
+                        load_data_cube(*args, **kwargs))
+
+    # the first image prepares the cube into the cache, the second one is memory mapped from it
+    cubes = [rvs_helpers.prepare_spectral_data(settings).array_data for _ in range(2)]
+
+    assert len(loaded) == 1
+    assert len(os.listdir(tmp_path / "cache")) == 1
+    for cube in cubes:
+        assert isinstance(cube, np.memmap) and cube.dtype == expected.dtype
+        np.testing.assert_array_equal(cube, expected)
+
+
+def write_calibration(cam_calibration_file, mtx, dist):
+    calibration = cv2.FileStorage(cam_calibration_file, cv2.FILE_STORAGE_WRITE)
+    calibration.write("K", mtx)
+    calibration.write("D", dist)
+    calibration.release()
+
+
+def test_cube_cache_depends_on_calibration(tmp_path, monkeypatch):
+    img_file = str(tmp_path / "image")
+    write_envi_image(img_file, random_cube("uint8"), "", wavelengths=WAVELENGTHS)
+    settings = {"inputImage": img_file + ".hdr", "experimentSettings": {"imageOptions": {"lensAngle": 30,
+                                                                                          "normalize": False}}}
+    # calibration files are read from calibration_data/ in the working folder
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("calibration_data")
+    mtx = np.array([[60., 0, 26], [0, 60., 18], [0, 0, 1]])
+
+    def load_coefficients(cam_calibration_file):
+        calibration = cv2.FileStorage(cam_calibration_file, cv2.FILE_STORAGE_READ)
+        return calibration.getNode("K").mat(), calibration.getNode("D").mat()
+
+    monkeypatch.setattr(rayn_utils, "load_coefficients", load_coefficients)
+    monkeypatch.setattr(rvs_helpers, "_undistort_maps", {})
+    monkeypatch.setattr(rvs_helpers, "CUBE_CACHE_DIR", str(tmp_path / "cache"))
+
+    cubes = []
+    for dist in ([[-0.3, 0.1, 0, 0, 0]], [[-0.3, 0.1, 0, 0, 0]], [[0.2, 0, 0, 0, 0]]):
+        write_calibration(rvs_helpers.calibration_file(30), mtx, np.array(dist))
+        cubes.append(np.array(rvs_helpers.prepare_spectral_data(settings).array_data))
+        expected = rayn_utils.undistort_data_cube(readimage(img_file).array_data, mtx, np.array(dist))
+        np.testing.assert_allclose(cubes[-1], expected, rtol=0, atol=1e-6)
+
+    # the recomputed calibration is not served from the cached cube of the old one
+    assert len(os.listdir(tmp_path / "cache")) == 2
+    assert not np.array_equal(cubes[2], cubes[0])
+
+
+def random_labeled_mask(rng, shape=(90, 120), n_labels=4):
+    """
+    Labeled mask with random objects: blobs with holes (and objects inside of the holes), tiny objects (a few pixels),
+    lines and objects touching the image border
+    """
+    labeled_mask = np.zeros(shape, dtype=np.int32)
+    for _ in range(rng.integers(3, 12)):
+        label = int(rng.integers(1, n_labels + 1))
+        x, y = int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0]))
+        kind = rng.integers(0, 5)
+        if kind == 0:  # blob with a hole and an object inside of it
+            radius = int(rng.integers(6, 20))
+            cv2.circle(labeled_mask, (x, y), radius, label, -1)
+            cv2.circle(labeled_mask, (x, y), radius // 2, 0, -1)
+            cv2.circle(labeled_mask, (x, y), radius // 5, label, -1)
+        elif kind == 1:  # tiny object
+            labeled_mask[y:y + rng.integers(1, 3), x:x + rng.integers(1, 3)] = label
+        elif kind == 2:  # line
+            cv2.line(labeled_mask, (x, y), (x + int(rng.integers(-15, 15)), y + int(rng.integers(-15, 15))), label)
+        elif kind == 3:  # rectangle touching the border
+            labeled_mask[:rng.integers(2, 15), x:x + rng.integers(2, 20)] = label
+        else:  # irregular blob
+            noise = rng.random((12, 12)) > 0.4
+            labeled_mask[y:y + 12, x:x + 12][noise[:shape[0] - y, :shape[1] - x]] = label
+
+    return labeled_mask
+
+
+def random_roi_items(rng, shape):
+    """
+    Random circles and rectangles inside of the image (PlantCV rejects ROIs extending outside of the image), they may
+    overlap each other
+    """
+    lines, samples = shape
+    roi_items = []
+    for _ in range(rng.integers(1, 7)):
+        width, height = int(rng.integers(4, 50)), int(rng.integers(4, 50))
+        if rng.random() < 0.5:
+            radius = int(width / 2)
+            roi_items.append(["Circle", int(rng.integers(radius, samples - radius + 1)),
+                              int(rng.integers(radius, lines - radius + 1)), width, width])
+        else:
+            # the center is an integer, the corner is at center - size / 2
+            roi_items.append(["Rectangle", int(rng.integers(-(-width // 2), (2 * samples - width) // 2 + 1)),
+                              int(rng.integers(-(-height // 2), (2 * lines - height) // 2 + 1)), width, height])
+
+    return roi_items
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_label_rois_matches_create_labels(seed):
+    rng = np.random.default_rng(seed)
+    mask = np.where(random_labeled_mask(rng) > 0, 255, 0).astype(np.uint8)
+    roi_items = random_roi_items(rng, mask.shape)
+
+    rois = rvs_helpers.process_rois(roi_items, mask)
+    expected, expected_n = pcv.create_labels(mask=mask, rois=rois, roi_type="partial")
+    labeled_mask, n_obj = rvs_helpers.label_rois(roi_items, mask)
+
+    assert n_obj == expected_n
+    np.testing.assert_array_equal(labeled_mask, expected)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_roi_statistics_matches_analyze_size(seed):
+    rng = np.random.default_rng(seed)
+    n_labels = 4
+    labeled_mask = random_labeled_mask(rng, n_labels=n_labels)
+
+    roi_stats = rvs_helpers.roi_statistics(labeled_mask, n_labels)
+
+    pcv.outputs.clear()
+    pcv.analyze.size(img=np.zeros(labeled_mask.shape + (3,), dtype=np.uint8), labeled_mask=labeled_mask,
+                     n_labels=n_labels, label="plant")
+    for i in range(n_labels):
+        observations = pcv.outputs.observations[f"plant_{i + 1}"]
+        for column in ("area", "width", "height", "perimeter"):
+            assert roi_stats[column][i] == pytest.approx(observations[column]["value"]), (i + 1, column)
+    pcv.outputs.clear()
+
+
+def test_roi_statistics_scales_to_pixel_size(monkeypatch):
+    labeled_mask = np.zeros((40, 50), dtype=np.int32)
+    labeled_mask[5:15, 10:30] = 1
+    monkeypatch.setattr(pcv.params, "px_width", 0.5)
+    monkeypatch.setattr(pcv.params, "px_height", 0.25)
+
+    roi_stats = rvs_helpers.roi_statistics(labeled_mask, 2)
+
+    assert roi_stats["area"].tolist() == [200 * 0.5 * 0.25, 0]
+    assert roi_stats["width"].tolist() == [20 * 0.5, 0]
+    assert roi_stats["height"].tolist() == [10 * 0.5, 0]
+
+
+RESULTS_FIELDS = [("roi", np.int32), ("index", "U32"), ("area", np.float64)]
+
+
+def test_results_store_keeps_long_strings(tmp_path):
+    store = rvs_helpers.ResultsStore(str(tmp_path), RESULTS_FIELDS)
+    long_index = "custom_index_" + "x" * 40
+    long_name = "plate_" + "0123456789" * 10
+    store.append(rvs_helpers.create_results_table(2, RESULTS_FIELDS, {"index": "ndvi"}), "image_1", 1600000000)
+    store.append(rvs_helpers.create_results_table(1, RESULTS_FIELDS, {"index": long_index}), long_name, 1600000001)
+    store.append(rvs_helpers.create_results_table(1, RESULTS_FIELDS, {"index": "ndvi"}), "image_3", 1600000002)
+
+    # the longer strings start a new chunk, a new store reads all of them (e.g. in another process)
+    assert len(store.chunks()) == 2
+    results = rvs_helpers.ResultsStore(str(tmp_path), RESULTS_FIELDS).read(fields=("image", "index", "roi"))
+    assert results["image"].tolist() == ["image_1", "image_1", long_name, "image_3"]
+    assert results["index"].tolist() == ["ndvi", "ndvi", long_index, "ndvi"]
+    assert results["roi"].tolist() == [1, 2, 1, 1]
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_tile_cube_indexing(tmp_path, lazy):
+    img_file = str(tmp_path / "image")
+    write_envi_image(img_file, np.random.default_rng(0).integers(0, 256, (30, 20, 4)).astype(np.uint8))
+    cube = rvs_helpers.open_envi_image(img_file).array_data
+    cube = cube if lazy else np.asarray(cube)
+    expected = np.asarray(cube)[5:17]
+
+    tile = rvs_helpers.TileCube(cube, slice(5, 17))
+    np.testing.assert_array_equal(np.asarray(tile), expected)
+    np.testing.assert_array_equal(tile[:, :, 2], expected[:, :, 2])
+    np.testing.assert_array_equal(tile[..., 2], expected[..., 2])
+    np.testing.assert_array_equal(tile[:, np.array([1, 4, 7])], expected[:, np.array([1, 4, 7])])
+    np.testing.assert_array_equal(tile[:, :, [0, 3]], expected[:, :, [0, 3]])
+    np.testing.assert_array_equal(tile[expected[:, :, 0] > 0.5], expected[expected[:, :, 0] > 0.5])
+
+
+def test_band_caching_cube_indexing():
+    cube = np.random.default_rng(0).random((30, 20, 4), dtype=np.float32)
+    cache = rvs_helpers.ArrayCache(2 ** 20)
+    band_caching_cube = rvs_helpers.BandCachingCube(cube, cache)
+
+    np.testing.assert_array_equal(band_caching_cube[:, :, 2], cube[:, :, 2])
+    assert ("band", 2) in cache
+    np.testing.assert_array_equal(band_caching_cube[np.array([1, 4]), :, 2], cube[np.array([1, 4]), :, 2])
+    np.testing.assert_array_equal(band_caching_cube[cube[:, :, 0] > 0.5], cube[cube[:, :, 0] > 0.5])
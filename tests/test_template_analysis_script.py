@@ -0,0 +1,48 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip("rayn_utils")  # provided by RVS Analytics
+pytest.importorskip("plantcv.plantcv")
+rvs_helpers = pytest.importorskip("rvs_helpers")
+
+from conftest import write_envi_image  # noqa: E402
+
+
+def execute_settings(img_file, out_folder, roi_items):
+    """
+    Settings dictionary of execute(), the mask is a threshold of the 800 nm band
+    """
+    return {"inputImage": img_file + ".hdr",
+            "outputFolder": out_folder,
+            "outputImage": os.path.join(out_folder, "mask_preview.png"),
+            "experimentSettings": {
+                "imageOptions": {"lensAngle": 0, "normalize": False},
+                "roiInfo": {"roiItems": roi_items},
+                "scriptOptions": {"general": {"custom_dropdown_script": "none", "dynamic_dropdown_script": "",
+                                              "example_thresh_script": 0.5, "example_checkbox_script": False}},
+                "analysis": {"chartOptions": {"plot_selection": "area"},
+                             "maskOptions": {"wavelength_mask": "800", "custom_dropdown_mask": "example_1",
+                                             "dynamic_dropdown_mask": "", "example_thresh_mask": 0.5,
+                                             "example_checkbox_mask": True}}}}
+
+
+def test_results_store_time_of_raw_binary(analysis_script, tmp_path, monkeypatch):
+    # image with the binary data in a .raw file, it was written before its header was changed
+    img_file = str(tmp_path / "image")
+    cube = np.zeros((60, 80, 4), dtype=np.uint8)
+    cube[10:30, 10:30] = 200
+    write_envi_image(img_file, cube, ".raw")
+    os.utime(img_file + ".raw", (1600000000.25, 1600000000.25))
+    os.utime(img_file + ".hdr", (1700000000, 1700000000))
+    monkeypatch.setattr(analysis_script, "RESULTS_STORE_DIR", str(tmp_path / "results"))
+
+    analysis_script.execute(rvs_helpers.MessageList(), "template_analysis_script",
+                            execute_settings(img_file, str(tmp_path / "output"), [["Rectangle", 20, 20, 30, 30]]), "")
+    rvs_helpers.get_image_writer().flush()
+
+    results = rvs_helpers.ResultsStore(str(tmp_path / "results"), analysis_script.RESULTS_FIELDS).read(
+        fields=("time", "image", "roi", "area"))
+    assert results["image"].tolist() == ["image"]
+    assert results["time"].tolist() == [np.datetime64(1600000000250, "ms").item()]
+    assert results["area"].tolist() == [400]